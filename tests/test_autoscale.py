@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import mock
+
+from walila.queue.autoscale import QueueDepthPolicy, QueueDepthAutoscaler
+
+
+def test_queue_depth_policy():
+    policy = QueueDepthPolicy(backlog_per_worker=10)
+    assert policy.desired(4, 0, 0, 1) == 0
+    assert policy.desired(4, 2, 0, 1) == 2
+    assert policy.desired(4, 2, 95, 1) == 12
+    assert policy.desired(4, 0, 100, 2) == 5
+
+
+def make_autoscaler(processes, depth):
+    pool = mock.Mock(num_processes=processes)
+    with mock.patch('walila.queue.autoscale.load_app_config') as config:
+        config.return_value.async_queues = 'default'
+        scaler = QueueDepthAutoscaler(pool, 20, 2, worker=mock.Mock())
+    scaler.poll_depth = mock.Mock(return_value=depth)
+    return scaler
+
+
+def test_autoscaler_bounded_steps():
+    scaler = make_autoscaler(2, (1000, 1))
+    assert scaler._maybe_scale()
+    scaler.pool.grow.assert_called_once_with(scaler.max_step)
+    # cooling down
+    assert not scaler._maybe_scale()
+
+    scaler = make_autoscaler(8, (0, 1))
+    assert scaler._maybe_scale()
+    scaler.pool.shrink.assert_called_once_with(scaler.max_step)
+
+    scaler = make_autoscaler(2, (0, 1))
+    assert not scaler._maybe_scale()
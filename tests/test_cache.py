@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import cPickle as pickle
+
+import mock
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import Session
+
+from walila.cache import (
+    LocalCache,
+    SingleFlight,
+    CacheClient,
+    CacheMixin,
+    InvalidationBus,
+    cached,
+    model_cache_hook,
+)
+from walila.db import model_base, make_session
+
+ModelBase = model_base()
+
+
+class Foo(ModelBase, CacheMixin):
+
+    __tablename__ = 'foo'
+    __cache_local_size__ = 10
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20))
+
+
+def test_local_cache():
+    cache = LocalCache(size=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # `b` is the least recently used
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    with mock.patch('walila.cache.time.time', return_value=0):
+        cache.set('d', 4, ttl=1)
+    assert cache.get('d') is None
+    cache.delete('a', 'c')
+    assert len(cache) == 0
+
+
+def test_model_registered():
+    assert Foo in model_cache_hook.models
+
+
+def _raw(value, ttl=60, delta=0):
+    return pickle.dumps((value, time.time() + ttl, delta))
+
+
+def test_load_from_db_in_new_session():
+    engines = {}
+    for role, name in (('master', 'a'), ('slave', 'stale')):
+        engines[role] = create_engine('sqlite://')
+        Foo.__table__.create(engines[role])
+        engines[role].execute(Foo.__table__.insert(),
+                              [{'id': 1, 'name': name}])
+    scoped = make_session(engines, scope='thread')
+    foo = scoped().query(Foo).using_bind('master').get(1)
+    foo.name = 'dirty'
+
+    manager = mock.Mock(**{'get_session.return_value': scoped})
+    with mock.patch('walila.db.db_manager', manager):
+        assert Foo._get_from_db(1)['name'] == 'a'
+        assert Foo._mget_from_db([1, 2]) == {1: {'id': 1, 'name': 'a'}}
+    # the caller's session is left as it is
+    assert foo in scoped().dirty
+    scoped.remove()
+
+
+@mock.patch('walila.cache.get_redis')
+def test_mget(get_redis):
+    Foo._cache().local.clear()
+    redis = get_redis.return_value
+    redis.mget.return_value = [_raw(Foo._dump(Foo(id=1, name='a'))), None]
+    with mock.patch.object(Foo, '_mget_from_db',
+                           return_value={2: Foo._dump(Foo(id=2, name='b'))}):
+        foos = Foo.mget([1, 2, 3])
+    assert sorted(foos) == [1, 2]
+    assert foos[2].name == 'b'
+    assert redis.pipeline.return_value.setex.call_count == 1
+
+    redis.mget.reset_mock()
+    assert Foo.get(1).name == 'a'
+    assert not redis.mget.called
+
+    Foo.invalidate(1)
+    redis.delete.assert_called_once_with(Foo._cache().make_key(1))
+    assert Foo._cache().local.get(Foo._cache().make_key(1)) is None
+
+
+def test_client_get_many():
+    redis = mock.Mock()
+    redis.mget.return_value = [_raw(1), None, _raw(None)]
+    client = CacheClient(prefix='t', local_size=10, redis_client=redis)
+    assert client.get_many(['a', 'b', 'c']) == {'a': 1, 'c': None}
+    redis.mget.assert_called_once_with(['t:a', 't:b', 't:c'])
+
+    # hits are kept locally
+    redis.mget.reset_mock()
+    assert client.get('a') == 1
+    assert not redis.mget.called
+
+    client.set_many({'b': 2}, ttl=10)
+    redis.pipeline.return_value.setex.assert_called_once_with(
+        't:b', 10, mock.ANY)
+    assert client.get('b') == 2
+
+
+def test_client_get_or_set_negative():
+    redis = mock.Mock()
+    redis.mget.return_value = [None]
+    client = CacheClient(prefix='t', local_size=10, negative_ttl=0,
+                         redis_client=redis)
+    assert client.get_or_set('a', lambda: None) is None
+    assert not redis.pipeline.called
+    assert client.get_or_set('a', lambda: None, negative_ttl=5) is None
+    redis.pipeline.return_value.setex.assert_called_once_with(
+        't:a', 5, mock.ANY)
+
+
+def test_client_early_recompute():
+    redis = mock.Mock()
+    redis.mget.return_value = [_raw('old', ttl=1, delta=10)]
+    client = CacheClient(prefix='t', local_size=0, redis_client=redis)
+    # computing takes far longer than the ttl left, recomputed early
+    with mock.patch('walila.cache.random.random', return_value=0.5):
+        assert client.get_or_set('a', lambda: 'new') == 'new'
+    assert client.get_or_set('a', lambda: 'new', beta=0) == 'old'
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return len(calls)
+
+    threads = [threading.Thread(
+        target=lambda: results.append(flight.do('a', compute)))
+        for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 5
+    assert flight.do('a', compute) == 2
+
+
+def test_cached():
+    client = mock.Mock()
+    client.get_or_set.side_effect = lambda key, func, **kw: func()
+
+    @cached(ttl=10, key='double:{0}', client=client)
+    def double(n):
+        return n * 2
+
+    assert double(2) == 4
+    client.get_or_set.assert_called_once_with(
+        'double:2', mock.ANY, ttl=10, negative_ttl=None)
+    double.invalidate(2)
+    client.delete.assert_called_once_with('double:2')
+
+    @cached(client=client)
+    def add(a, b=0):
+        return a + b
+
+    assert add.make_key(1, b=2) == add.make_key(1, b=2) != add.make_key(1)
+
+
+@mock.patch.object(Foo, 'invalidate')
+def test_invalidate_after_commit(invalidate):
+    session = Session()
+    session.info[model_cache_hook.INFO_KEY] = {(Foo, 1), (Foo, 2)}
+    model_cache_hook._after_commit(session)
+    assert sorted(invalidate.call_args[0]) == [1, 2]
+    assert model_cache_hook.INFO_KEY not in session.info
+
+
+@mock.patch.object(InvalidationBus, 'enabled', True)
+@mock.patch('walila.cache.get_redis')
+def test_invalidation_bus_publish(get_redis):
+    bus = InvalidationBus(channel='c', batch_size=2)
+    with bus.batch():
+        bus.publish(['a', 'b'])
+        with bus.batch():
+            bus.publish(['c', 'a'])
+        assert not get_redis.return_value.publish.called
+    published = [json.loads(call[0][1])['keys'] for call
+                 in get_redis.return_value.publish.call_args_list]
+    assert len(published) == 2
+    assert sorted(sum(published, [])) == ['a', 'b', 'c']
+
+
+def test_invalidation_bus_evict():
+    bus = InvalidationBus()
+    client = CacheClient(prefix='t', local_size=10, redis_client=mock.Mock())
+    bus.register(client)
+    client.local.set('t:a', (1, time.time() + 60, 0))
+    client.local.set('t:b', (2, time.time() + 60, 0))
+
+    # from this process, evicted when deleting
+    bus._handle({'type': 'message', 'data': json.dumps(
+        {'source': bus.source, 'keys': ['t:a']})})
+    assert client.local.get('t:a') is not None
+    bus._handle({'type': 'message', 'data': json.dumps(
+        {'source': 'other:1', 'keys': ['t:a']})})
+    assert client.local.get('t:a') is None
+    assert client.local.get('t:b') is not None
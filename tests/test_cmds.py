@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import threading
+
+import mock
+
+from walila.cmds.consumer import (
+    _derive_concurrency,
+    _forward_signal,
+    _run_processes,
+)
+
+
+@mock.patch('walila.cmds.consumer.get_cpu_count', mock.Mock(return_value=4))
+def test_derive_concurrency():
+    assert _derive_concurrency('prefork', None, None) == (4, 1)
+    assert _derive_concurrency('prefork', 2, 3) == (2, 3)
+    assert _derive_concurrency('gevent', None, None) == (1000, 4)
+    assert _derive_concurrency('eventlet', 100, 2) == (100, 2)
+
+
+@mock.patch('walila.cmds.consumer.os.kill')
+def test_forward_signal(kill):
+    _forward_signal([1, 2], signal.SIGINT)
+    kill.assert_has_calls([mock.call(1, signal.SIGTERM),
+                           mock.call(2, signal.SIGTERM)])
+    kill.reset_mock()
+    kill.side_effect = [OSError, None]
+    _forward_signal([1, 2], signal.SIGQUIT)
+    kill.assert_called_with(2, signal.SIGQUIT)
+
+
+def test_run_processes_wait_children():
+    def worker(index):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda sig, frame: stopping.append(1))
+        while not stopping:
+            time.sleep(0.01)
+        # a warm shutdown
+        time.sleep(0.3)
+        raise SystemExit(3)
+
+    start = time.time()
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    assert _run_processes(worker, 2) == 3
+    assert time.time() - start >= 0.5
@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+
+import time
+import Queue
+import threading
+
+import gevent
+import mock
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, text
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.orm import Query
+from sqlalchemy.pool import QueuePool
+
+from walila.db import (
+    model_base,
+    UpsertMixin,
+    execute_cached,
+    ReplicaTracker,
+    ReplicaStat,
+    RoutingSession,
+    RoutingQuery,
+    ReadYourWrites,
+    GreenletScopedSession,
+    DBManager,
+    ConnectionQuarantine,
+    CounterBuffer,
+    ShardedRoutingSession,
+    GatherTimeout,
+    hash_shard,
+    RangeShard,
+    make_session as make_scoped_session,
+)
+from walila.metrics import metrics
+
+ModelBase = model_base()
+
+
+class Counter(ModelBase, UpsertMixin):
+
+    __tablename__ = 'counter'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20), unique=True)
+    hits = Column(Integer)
+
+
+def compile_mysql(stmt):
+    return str(stmt.compile(dialect=mysql.dialect()))
+
+
+def test_upsert():
+    sql = compile_mysql(Counter.upsert().values(name='a', hits=1))
+    assert sql.endswith(
+        'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), '
+        'name = VALUES(name), hits = VALUES(hits)')
+
+
+def test_upsert_on_duplicate():
+    stmt = Counter.upsert().values([
+        {'name': 'a', 'hits': 1},
+        {'name': 'b', 'hits': 2},
+    ]).on_duplicate(hits='hits + VALUES(hits)')
+    sql = compile_mysql(stmt)
+    assert 'VALUES (%s, %s), (%s, %s)' in sql
+    assert sql.endswith('name = VALUES(name), hits = hits + VALUES(hits)')
+
+
+def test_upsert_update_only():
+    stmt = Counter.upsert().update_only('hits')
+    sql = str(stmt.compile(dialect=mysql.dialect(),
+                           column_keys=['name', 'hits']))
+    assert 'VALUES (%s, %s)' in sql
+    assert sql.endswith('id = LAST_INSERT_ID(id), hits = VALUES(hits)')
+
+
+def test_bulk_upsert():
+    rows = [{'name': str(i), 'hits': i} for i in range(5)] + [{'name': 'x'}]
+    session = mock.MagicMock()
+    new_session = session.session_factory.return_value
+    db = new_session.using_bind.return_value.__enter__.return_value
+    conn = db.connection.return_value.execution_options.return_value
+    conn.execute.return_value.rowcount = 2
+    assert Counter.bulk_upsert(rows, chunk_size=2, session=session) == 8
+    new_session.using_bind.assert_called_once_with('master')
+    assert not session.called
+    stmts = set(call[0][0] for call in conn.execute.call_args_list)
+    assert stmts == {Counter.cached_upsert()}
+    chunks = [call[0][1] for call in conn.execute.call_args_list]
+    assert chunks == [rows[:2], rows[2:4], rows[4:5], rows[5:]]
+
+
+@mock.patch.object(CounterBuffer, '_ensure_flusher', mock.Mock())
+def test_counter_buffer():
+    stmt = Counter.cached_upsert(increment_columns=['hits'])
+    assert stmt is Counter.cached_upsert(increment_columns=['hits'])
+    sql = str(stmt.compile(dialect=mysql.dialect(), column_keys=['name',
+                                                                 'hits']))
+    assert sql.endswith(
+        'name = VALUES(name), hits = COALESCE(hits, 0) + VALUES(hits)')
+
+    buffer = CounterBuffer(flush_interval=60, buffer_size=3)
+    with mock.patch.object(Counter, 'bulk_upsert') as bulk_upsert:
+        buffer.incr(Counter, 1, hits=1)
+        buffer.incr(Counter, 1, hits=2)
+        buffer.incr(Counter, 2, hits=1)
+        assert not bulk_upsert.called
+        assert buffer.flush() == 2
+        rows, = bulk_upsert.call_args[0]
+        assert {row['id']: row['hits'] for row in rows} == {1: 3, 2: 1}
+        assert bulk_upsert.call_args[1] == {'increment_columns': {'hits'}}
+
+        bulk_upsert.side_effect = RuntimeError
+        buffer.incr(Counter, 1, hits=1)
+        assert buffer.flush() == 0
+        bulk_upsert.side_effect = None
+        buffer.incr(Counter, 1, hits=1)
+        buffer.incr(Counter, 2, hits=1)
+        assert not buffer._wakeup.is_set()
+        buffer.incr(Counter, 3, hits=1)
+        # the flusher is woken up, callers never flush
+        assert buffer._wakeup.is_set()
+        assert bulk_upsert.call_count == 2
+        assert buffer.flush() == 3
+        rows, = bulk_upsert.call_args[0]
+        assert {row['id']: row['hits'] for row in rows} == \
+            {1: 2, 2: 1, 3: 1}
+
+
+def test_bulk_upsert_in_new_session():
+    engine = create_engine('sqlite://')
+    Counter.__table__.create(engine)
+    scoped = make_scoped_session({'master': engine, 'slave': engine})
+    session = scoped()
+    counter = Counter(id=1, name='a', hits=1)
+    session.add(counter)
+    # no upsert on sqlite
+    with mock.patch('walila.db.execute_cached',
+                    lambda db, stmt, rows: db.execute(
+                        Counter.__table__.insert(), rows)):
+        Counter.bulk_upsert([{'id': 2, 'name': 'b', 'hits': 1}],
+                            session=scoped)
+    # the caller's session is neither committed nor closed
+    assert counter in session.new
+    session.rollback()
+    assert [c.id for c in scoped().query(Counter)] == [2]
+
+
+def test_compiled_cache():
+    engine = create_engine('sqlite://')
+    session = RoutingSession({'master': engine, 'slave': engine})
+    stmt = text('SELECT :x')
+    with mock.patch.object(stmt, 'compile', wraps=stmt.compile) as compile:
+        for i in range(3):
+            assert execute_cached(session, stmt, {'x': i}).scalar() == i
+    assert compile.call_count == 1
+
+    assert Counter.cached_upsert(['hits']) is \
+        Counter.cached_upsert(('hits',))
+    assert Counter.cached_upsert() is not Counter.cached_upsert(['hits'])
+
+
+def make_tracker(*stats):
+    tracker = ReplicaTracker(range(len(stats)), interval=5, max_lag=30)
+    for engine, (healthy, lag, latency) in enumerate(stats):
+        stat = tracker.stats[engine]
+        stat.healthy, stat.lag, stat.latency = healthy, lag, latency
+        stat.sampled_at = 1
+    return tracker
+
+
+def test_replica_tracker_choose():
+    tracker = make_tracker((True, 0, 0.01), (False, 0, 0.001), (True, 20, 1))
+    assert tracker.choose([1]) is None
+    assert tracker.choose([0, 1, 2], max_lag=10) == 0
+    assert tracker.choose([1, 2], max_lag=10) is None
+    chosen = [tracker.choose([0, 1, 2]) for _ in range(1000)]
+    assert 1 not in chosen
+    assert chosen.count(0) > chosen.count(2)
+
+
+def test_replica_tracker_sample():
+    tracker = ReplicaTracker([], interval=5, max_lag=30)
+    engine = mock.MagicMock()
+    tracker.stats[engine] = ReplicaStat()
+    conn = engine.connect.return_value.__enter__.return_value
+
+    conn.execute.return_value.first.return_value = {
+        'Seconds_Behind_Master': 3}
+    stat = tracker.sample(engine)
+    assert stat.healthy and stat.lag == 3 and stat.latency is not None
+
+    conn.execute.return_value.first.return_value = {
+        'Seconds_Behind_Master': None}
+    assert not tracker.sample(engine).healthy
+
+    conn.execute.side_effect = RuntimeError
+    assert not tracker.sample(engine).healthy
+
+    # no REPLICATION CLIENT privilege
+    conn.execute.side_effect = OperationalError(
+        'SHOW SLAVE STATUS', {}, Exception(1227, 'Access denied'))
+    stat = tracker.sample(engine)
+    assert stat.healthy and stat.lag is None
+    assert tracker.choose([engine]) is engine
+    assert tracker.choose([engine], max_lag=10) is None
+
+    conn.execute.side_effect = OperationalError(
+        'SHOW SLAVE STATUS', {}, Exception(2013, 'Lost connection'))
+    assert not tracker.sample(engine).healthy
+
+
+def test_replica_tracker_thread():
+    engine = mock.MagicMock()
+    tracker = ReplicaTracker([engine], interval=0.01, max_lag=30)
+    conn = engine.connect.return_value.__enter__.return_value
+    conn.execute.side_effect = RuntimeError
+    with mock.patch('walila.db.logger') as logger:
+        tracker.start()
+        # sampled without yielding to gevent
+        time.sleep(0.1)
+        assert not tracker.stats[engine].healthy
+        assert logger.warning.call_count == 1
+
+        conn.execute.side_effect = None
+        conn.execute.return_value.first.return_value = None
+        time.sleep(0.1)
+        tracker.stop()
+    assert tracker.stats[engine].healthy
+    assert logger.warning.call_count == 2
+    assert not logger.exception.called
+
+
+def make_session(read_your_writes=None):
+    engines = {'master': mock.Mock(name='master'),
+               'slave': mock.Mock(name='slave')}
+    return RoutingSession(engines, read_your_writes=read_your_writes)
+
+
+def test_routing_session_writes_to_master():
+    session = make_session()
+    master, slave = session.engines['master'], session.engines['slave']
+    assert session.get_bind(clause=Counter.upsert()) is master
+    assert session.get_bind(clause=Counter.__table__.select()) is slave
+
+
+def test_read_your_writes_until_removed():
+    master, slave = mock.Mock(name='master'), mock.Mock(name='slave')
+    scoped = make_scoped_session({'master': master, 'slave': slave},
+                                 read_your_writes=ReadYourWrites())
+    assert scoped().get_bind() is slave
+    with scoped() as db:
+        db.get_bind(clause=Counter.__table__.delete())
+    # closed by the block, but still in the same request
+    assert scoped().get_bind() is master
+    scoped.remove()
+    assert scoped().get_bind() is slave
+
+
+def test_read_your_writes_window():
+    session = make_session(ReadYourWrites(window=2))
+    master, slave = session.engines['master'], session.engines['slave']
+    with mock.patch('walila.db.time.time', return_value=100):
+        session.get_bind(clause=Counter.__table__.delete())
+    with mock.patch('walila.db.time.time', return_value=101):
+        session.close()
+        assert session.get_bind() is master
+    with mock.patch('walila.db.time.time', return_value=103):
+        assert session.get_bind() is slave
+
+
+def test_read_your_writes_gtid():
+    session = make_session(ReadYourWrites(gtid=True))
+    master, slave = session.engines['master'], session.engines['slave']
+    session.get_bind(clause=Counter.__table__.delete())
+    master.scalar.return_value = 'uuid:1-10'
+    session.commit()
+    assert session._write_gtid == 'uuid:1-10'
+
+    slave.scalar.return_value = 0
+    assert session.get_bind() is master
+    slave.scalar.return_value = 1
+    assert session.get_bind() is slave
+    assert session.get_bind() is slave
+    assert slave.scalar.call_count == 2
+
+
+def test_bind_scope():
+    session = make_session()
+    master, slave = session.engines['master'], session.engines['slave']
+    with session.bind_scope('master'):
+        assert session.get_bind() is master
+        with session.bind_scope(max_lag=1):
+            assert session.get_bind() is master
+    assert session.get_bind() is slave
+
+    session.using_bind('master')
+    assert session.get_bind() is master
+    session.close()
+    assert session.get_bind() is slave
+
+
+def test_query_using_bind():
+    session = make_session()
+    session._query_cls = RoutingQuery
+    master, slave = session.engines['master'], session.engines['slave']
+    with mock.patch.object(Query, '_connection_from_session',
+                           lambda q, **kw: q.session.get_bind()):
+        query = session.query(Counter)
+        assert query.using_bind('master')._connection_from_session() \
+            is master
+        assert query._connection_from_session() is slave
+    assert session.get_bind() is slave
+
+
+def test_query_using_bind_bulk_writes():
+    engines = {}
+    for role in ('master', 'slave'):
+        engines[role] = create_engine('sqlite://')
+        Counter.__table__.create(engines[role])
+        engines[role].execute(Counter.__table__.insert(),
+                              [{'id': 1, 'name': 'a', 'hits': 0}])
+    session = RoutingSession(engines, query_cls=RoutingQuery)
+    query = session.query(Counter).using_bind('slave')
+    assert query.update({Counter.hits: 5}, synchronize_session=False) == 1
+    session.commit()
+    hits = {role: engine.scalar('SELECT hits FROM counter')
+            for role, engine in engines.iteritems()}
+    assert hits == {'master': 0, 'slave': 5}
+    assert query.delete(synchronize_session=False) == 1
+    session.commit()
+    assert engines['master'].scalar('SELECT COUNT(*) FROM counter') == 1
+    assert session.get_bind(clause=Counter.__table__.delete()) is \
+        engines['master']
+
+
+@mock.patch('walila.db.monkey.is_module_patched', mock.Mock(return_value=True))
+def test_greenlet_scoped_session():
+    import gevent
+    DBSession = make_scoped_session({'master': mock.Mock(),
+                                     'slave': mock.Mock()}, scope='greenlet')
+    assert isinstance(DBSession, GreenletScopedSession)
+    main = DBSession()
+    assert DBSession() is main
+    sessions = [g.value for g in gevent.joinall(
+        [gevent.spawn(DBSession), gevent.spawn(DBSession)])]
+    assert len(set(map(id, sessions + [main]))) == 3
+
+    DBSession.remove()
+    assert DBSession() is not main
+
+
+def test_warm_up():
+    master, slave = mock.MagicMock(), mock.MagicMock()
+    master.pool.size.return_value = slave.pool.size.return_value = 2
+    slave.raw_connection.side_effect = [mock.Mock(), RuntimeError]
+    manager = DBManager()
+    manager.session_map['test'] = make_scoped_session(
+        {'master': master, 'slave': slave})
+
+    assert manager.warm_up(connections=3, queries=['SELECT 1']) == 3
+    assert master.raw_connection.call_count == 2
+    conn = master.raw_connection.return_value
+    conn.cursor.return_value.execute.assert_called_with('SELECT 1')
+    assert conn.close.call_count == 2
+    assert manager.warm_up(connections=0) == 0
+
+
+def make_sqlite_session(rows):
+    engine = create_engine('sqlite://')
+    Counter.__table__.create(engine)
+    engine.execute(Counter.__table__.insert(), rows)
+    return RoutingSession({'master': engine, 'slave': engine})
+
+
+def test_stream():
+    session = make_sqlite_session(
+        [{'id': i, 'name': str(i), 'hits': i} for i in range(1, 6)])
+    chunks = list(session.stream(session.query(Counter), chunk_size=2))
+    assert [[c.id for c in chunk] for chunk in chunks] == [[1, 2], [3, 4], [5]]
+
+
+def test_iter_keyset():
+    session = make_sqlite_session(
+        [{'id': i, 'name': str(i), 'hits': i % 2} for i in range(1, 8)])
+    query = session.query(Counter).filter(Counter.hits == 1).order_by(
+        Counter.name.desc())
+    chunks = list(session.iter_keyset(query, chunk_size=2))
+    assert [[c.id for c in chunk] for chunk in chunks] == [[1, 3], [5, 7]]
+
+    query = session.query(Counter.name, Counter.hits)
+    chunks = list(session.iter_keyset(query, chunk_size=3, key=Counter.name))
+    assert [[row.name for row in chunk] for chunk in chunks] == \
+        [['1', '2', '3'], ['4', '5', '6'], ['7']]
+
+
+def test_baked_get():
+    engine = create_engine('sqlite://')
+    Counter.__table__.create(engine)
+    engine.execute(Counter.__table__.insert(), id=1, name='a', hits=1)
+    session = RoutingSession({'master': engine, 'slave': engine},
+                             query_cls=RoutingQuery)
+    query = session.query(Counter)
+    assert query._bakeable()
+    assert not query.populate_existing()._bakeable()
+    assert not session.query(Counter.id)._bakeable()
+    filtered = query.filter(Counter.hits == 99)
+    assert not filtered._bakeable()
+    assert not query.order_by(Counter.name)._bakeable()
+    assert not query.limit(1)._bakeable()
+    with mock.patch('walila.db.settings', mock.Mock(DB_BAKED_QUERIES=True)):
+        assert query.get(1).name == 'a'
+        with pytest.raises(InvalidRequestError):
+            filtered.get(1)
+
+    assert query._baked_get(1).name == 'a'
+    assert query._baked_get(2) is None
+    session.close()
+    with mock.patch('sqlalchemy.orm.query.Query._compile_context') as compile:
+        assert query.using_bind('master')._baked_get(1).hits == 1
+    assert not compile.called
+
+
+def test_mysql_server_side_cursor():
+    from sqlalchemy.dialects.mysql.base import MySQLExecutionContext
+    create_cursor = MySQLExecutionContext.create_cursor.__func__
+    context = mock.Mock(execution_options={'stream_results': True})
+    context.compiled.statement = Counter.__table__.select()
+    sscursor = context.dialect.dbapi.cursors.SSCursor
+    create_cursor(context)
+    context._dbapi_connection.cursor.assert_called_once_with(sscursor)
+
+    context.execution_options = {}
+    context._dbapi_connection.cursor.reset_mock()
+    create_cursor(context)
+    context._dbapi_connection.cursor.assert_called_once_with()
+
+
+def test_rollback_timeout_quarantine():
+    engine = create_engine('sqlite://',
+                           execution_options={'close_timeout': 0.01})
+    session = RoutingSession({'master': engine, 'slave': engine})
+    session.execute('SELECT 1')
+    transaction = session.transaction
+    with mock.patch.object(engine.dialect, 'do_rollback',
+                           side_effect=lambda conn: gevent.sleep(1)), \
+            mock.patch('walila.db.connection_quarantine') as quarantine:
+        session.rollback()
+    quarantine.put.assert_called_once_with(transaction)
+    assert session.transaction is not transaction
+    assert not session.transaction._connections
+
+
+def test_quarantine_clean():
+    engine = create_engine('sqlite://', execution_options={'db': 'test'})
+    quarantine = ConnectionQuarantine()
+    metrics.reset()
+
+    conn = engine.connect()
+    quarantine.clean(conn, conn.begin(), True)
+    assert conn.closed
+    assert metrics.counters['db.test.default.quarantine.recovered'] == 1
+
+    conn = engine.connect()
+    with mock.patch.object(engine.dialect, 'do_rollback',
+                           side_effect=gevent.Timeout):
+        quarantine.clean(conn, conn.begin(), True)
+    assert metrics.counters['db.test.default.quarantine.invalidated'] == 1
+
+
+def test_quarantine_concurrency():
+    engine = create_engine('sqlite://')
+    conns = [engine.connect() for _ in range(2)]
+    transaction = mock.Mock(_connections={
+        i: (conn, conn.begin(), True) for i, conn in enumerate(conns)})
+    quarantine = ConnectionQuarantine(concurrency=2)
+    lock = threading.Lock()
+    cleaning = []
+    both = threading.Event()
+    done = Queue.Queue()
+
+    def clean(conn, trans, autoclose):
+        with lock:
+            cleaning.append(conn)
+            if len(cleaning) == 2:
+                both.set()
+        # the other one is cleaned meanwhile
+        done.put(both.wait(1))
+
+    with mock.patch.object(quarantine, 'clean', side_effect=clean):
+        quarantine.put(transaction)
+        assert [done.get(timeout=2) for _ in conns] == [True, True]
+
+
+def make_sharded_session(n):
+    sessions = []
+    for i in range(n):
+        engine = create_engine('sqlite://')
+        Counter.__table__.create(engine)
+        sessions.append(('shard_%d' % i, make_scoped_session(
+            {'master': engine, 'slave': engine})))
+    return ShardedRoutingSession('counter', sessions)
+
+
+def test_shard_key():
+    shards = ['a', 'b', 'c']
+    assert hash_shard(42, shards) == hash_shard(42L, shards)
+    assert hash_shard(u'key', shards) == hash_shard('key', shards)
+    assert len({hash_shard(i, shards) for i in range(30)}) == 3
+
+    range_shard = RangeShard([100, 200])
+    assert [range_shard(key, shards) for key in (0, 99, 100, 250)] == \
+        ['a', 'a', 'b', 'c']
+
+
+def test_sharded_routing_session():
+    sharded = make_sharded_session(2)
+    for i in range(10):
+        with sharded(i) as session:
+            session.add(Counter(id=i, name=str(i), hits=i))
+
+    counts = sharded.scatter(lambda session: session.query(Counter).count())
+    assert sorted(counts) == ['shard_0', 'shard_1']
+    assert sum(counts.values()) == 10
+    assert sharded(3).query(Counter).get(3).hits == 3
+
+    names = sharded.gather(
+        lambda session: [c.name for c in session.query(Counter)],
+        key=int, reverse=True, limit=3)
+    assert names == ['9', '8', '7']
+
+
+def test_sharded_gather_errors():
+    sharded = make_sharded_session(2)
+
+    def slow(session):
+        gevent.sleep(1)
+
+    with pytest.raises(GatherTimeout):
+        sharded.scatter(slow, timeout=0.01)
+
+    def fail(session):
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        sharded.scatter(fail, shards=['shard_1'])
+
+
+def test_add_sharded_session():
+    manager = DBManager()
+    for name in ('c0', 'c1', 'c2'):
+        manager.session_map[name] = mock.Mock()
+    sharded = manager.add_sharded_session(
+        'counter', {'shards': ['c0', 'c1', 'c2'], 'shard_key': 'range',
+                    'ranges': [10, 20]})
+    assert manager.get_sharded_session('counter') is sharded
+    assert sharded.get_session(15) is manager.session_map['c1']
+
+    with pytest.raises(ValueError):
+        manager.add_sharded_session(
+            'other', {'shards': ['c0', 'c1'], 'shard_key': 'range',
+                      'ranges': [10, 20]})
+
+
+def test_gather():
+    manager = DBManager()
+    for name, hits in (('a', 1), ('b', 2)):
+        engine = create_engine('sqlite://')
+        Counter.__table__.create(engine)
+        engine.execute(Counter.__table__.insert(), id=1, name=name,
+                       hits=hits)
+        manager.session_map[name] = make_scoped_session(
+            {'master': engine, 'slave': engine})
+
+    def get_hits(session):
+        return session.query(Counter).get(1).hits
+
+    def slow(session):
+        gevent.sleep(1)
+
+    assert manager.gather({'x': ('a', get_hits), 'y': ('b', get_hits)}) == \
+        {'x': 1, 'y': 2}
+    with pytest.raises(GatherTimeout):
+        manager.gather({'x': ('a', get_hits), 'y': ('b', slow, 0.01)},
+                       timeout=10)
+    with pytest.raises(KeyError):
+        manager.gather({'x': ('c', get_hits)})
+
+
+def test_reset_pools():
+    engine = create_engine('sqlite:///:memory:', poolclass=QueuePool)
+    manager = DBManager()
+    manager.session_map['test'] = make_scoped_session(
+        {'master': engine, 'slave': engine})
+    conn = engine.connect()
+    conn.close()
+    pool = engine.pool
+    assert pool.checkedin() == 1
+    with mock.patch.object(pool, 'dispose') as dispose:
+        manager.reset_pools()
+    assert engine.pool is not pool and engine.pool.checkedin() == 0
+    # connections of the parent are not closed
+    assert not dispose.called and pool.checkedin() == 1
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+import mock
+import pytest
+from sqlalchemy import MetaData, UniqueConstraint, create_engine
+
+from walila import model
+from walila.db import RoutingSession
+from walila.model import FailedTask, failed_task_db
+from walila.queue.recorder import FailedTaskRecorder
+from walila.settings import ConfigError
+
+
+def db_settings(**kwargs):
+    options = dict(FAILED_TASK_DB='walila', DB_SETTINGS={'walila': {}})
+    options.update(kwargs)
+    return mock.patch('walila.model.settings', mock.Mock(**options))
+
+
+def record(recorder, exception_msg='boom', task_id='1'):
+    recorder.record(
+        name='add', full_name='tasks.add', args='[1, 2]', kwargs='{}',
+        exception_class='ValueError', exception_msg=exception_msg,
+        traceback='tb', task_id=task_id, need_retry=True)
+
+
+def test_make_fingerprint():
+    fp = FailedTask.make_fingerprint(
+        'tasks.add', '[1, 2]', '{}', 'ValueError', u'错误')
+    assert len(fp) == 40
+    assert fp == FailedTask.make_fingerprint(
+        'tasks.add', '[1, 2]', '{}', 'ValueError', u'错误'.encode('utf8'))
+    assert fp != FailedTask.make_fingerprint(
+        'tasks.add', '[1, 2]', '{}', 'ValueError', 'other')
+
+
+@db_settings()
+@mock.patch.object(FailedTaskRecorder, '_ensure_flusher', mock.Mock())
+def test_recorder_aggregates_failures():
+    recorder = FailedTaskRecorder(flush_interval=60, buffer_size=10)
+    record(recorder, task_id='1')
+    record(recorder, task_id='2')
+    record(recorder, exception_msg='other')
+
+    with mock.patch.object(FailedTask, 'save_failures') as save:
+        assert recorder.flush() == 3
+    rows = sorted(save.call_args[0][0], key=lambda row: row['failures'])
+    assert [row['failures'] for row in rows] == [1, 2]
+    assert rows[1]['task_id'] == '2'
+    assert recorder.flush() == 0
+
+
+@db_settings()
+@mock.patch.object(FailedTaskRecorder, '_ensure_flusher', mock.Mock())
+def test_recorder_requeue_on_error():
+    recorder = FailedTaskRecorder(flush_interval=60, buffer_size=10)
+    record(recorder)
+    with mock.patch.object(FailedTask, 'save_failures',
+                           side_effect=RuntimeError):
+        assert recorder.flush() == 0
+    record(recorder)
+    with mock.patch.object(FailedTask, 'save_failures') as save:
+        assert recorder.flush() == 2
+    assert save.call_args[0][0][0]['failures'] == 2
+
+
+def test_failed_task_db():
+    with db_settings():
+        assert failed_task_db() == 'walila'
+    with db_settings(FAILED_TASK_DB='other'), pytest.raises(ConfigError):
+        failed_task_db()
+    model._fallback_warned.clear()
+    with db_settings(FAILED_TASK_DB=''):
+        with mock.patch('walila.model.logger') as logger:
+            assert failed_task_db() == 'walila'
+            assert failed_task_db() == 'walila'
+        assert logger.warning.call_count == 1
+    with db_settings(FAILED_TASK_DB='', DB_SETTINGS={'a': {}, 'b': {}}):
+        recorder = FailedTaskRecorder()
+        with pytest.raises(ConfigError):
+            record(recorder)
+
+
+def test_retrier_dispatch():
+    from collections import namedtuple
+    from walila.queue.retry import FailedTaskRetrier
+
+    Row = namedtuple('Row', 'id name args kwargs')
+    task_manager = mock.MagicMock()
+    task_manager.__contains__.side_effect = lambda name: name == 'add'
+    retrier = FailedTaskRetrier(concurrency=2, task_manager=task_manager)
+    rows = [Row(1, 'add', '[1, 2]', '{}'), Row(2, 'unknown', '[]', '{}'),
+            Row(3, 'add', '[3, 4]', '{"z": 1}')]
+    assert retrier.dispatch(rows) == [1, 3]
+    task_manager.apply_async.assert_any_call('add', 3, 4, z=1)
+
+
+@db_settings()
+@mock.patch.object(FailedTaskRecorder, '_ensure_flusher', mock.Mock())
+def test_recorder_never_flushes_on_failure_path():
+    recorder = FailedTaskRecorder(flush_interval=60, buffer_size=1)
+    with mock.patch.object(FailedTask, 'save_failures') as save:
+        record(recorder)
+    assert not save.called
+    assert recorder._wakeup.is_set()
+
+
+@db_settings()
+@mock.patch.object(FailedTaskRecorder, '_ensure_flusher', mock.Mock())
+def test_recorder_flush_waits_for_saving():
+    recorder = FailedTaskRecorder(flush_interval=60, buffer_size=10)
+    record(recorder)
+    saving, saved = threading.Event(), threading.Event()
+
+    def save(rows):
+        saving.set()
+        saved.wait(1)
+
+    flushed = []
+    with mock.patch.object(FailedTask, 'save_failures', side_effect=save):
+        # by the flusher
+        flusher = threading.Thread(target=recorder.flush)
+        flusher.start()
+        saving.wait(1)
+        # on shutdown
+        shutdown = threading.Thread(
+            target=lambda: flushed.append(recorder.flush()))
+        shutdown.start()
+        time.sleep(0.05)
+        assert not flushed
+        saved.set()
+        shutdown.join(1)
+        flusher.join(1)
+    assert flushed == [0]
+
+
+def test_save_failures_in_chunks():
+    from walila.queue.recorder import truncate_traceback
+
+    assert truncate_traceback('tb', limit=10) == 'tb'
+    assert truncate_traceback('x' * 5 + 'Error', limit=5) == '...\nError'
+
+    rows = [{'fingerprint': str(i), 'failures': 1,
+             'traceback': 'x' * 1000} for i in range(10)]
+    with mock.patch.object(FailedTask, 'bulk_upsert',
+                           return_value=10) as bulk_upsert, \
+            mock.patch('walila.model.get_session') as get_session:
+        assert FailedTask.save_failures(rows) == 10
+    bulk_upsert.assert_called_once_with(
+        rows, session=get_session.return_value,
+        increment_columns=['failures'])
+
+
+@mock.patch('walila.model.get_session')
+def test_backfill_in_new_sessions(get_session):
+    scoped = get_session.return_value
+    db = scoped.session_factory.return_value.using_bind.return_value.\
+        __enter__.return_value
+    db.query.return_value.filter.return_value.order_by.return_value.\
+        limit.return_value.all.return_value = []
+    assert FailedTask.backfill_fingerprints() == 0
+    assert not scoped.called
+
+
+def make_failed_task_session():
+    # no UNIQUE key of `fingerprint` yet
+    engine = create_engine('sqlite://')
+    table = FailedTask.__table__.tometadata(MetaData())
+    table.c.fingerprint.nullable = True
+    table.constraints = set(c for c in table.constraints
+                            if not isinstance(c, UniqueConstraint))
+    table.create(engine)
+    for i, fingerprint in enumerate([None, 'x', None, 'x', None]):
+        engine.execute(table.insert(), {
+            'id': i + 1, 'fingerprint': fingerprint, 'name': 'add',
+            'full_name': 'tasks.add', 'args': '[%d]' % (i % 2),
+            'kwargs': '{}', 'exception_class': 'E', 'exception_msg': '',
+            'task_id': str(i), 'failures': 1, 'need_retry': True})
+    return RoutingSession({'master': engine, 'slave': engine})
+
+
+def test_merge_fingerprints():
+    db = make_failed_task_session()
+    assert FailedTask._backfill_batch(db, 0, 2) == (3, 1)
+    assert FailedTask._backfill_batch(db, 3, 2) == (5, 1)
+    assert FailedTask._backfill_batch(db, 5, 2) == (None, 0)
+    assert FailedTask._merge_duplicates(db) == 1
+    db.flush()
+    failures = {task.id: (task.fingerprint, task.failures)
+                for task in db.query(FailedTask)}
+    fingerprint = failures[1][0]
+    assert failures == {1: (fingerprint, 3), 2: ('x', 2)}
+
+
+@mock.patch('walila.model.get_session')
+def test_add_fingerprint_key(get_session):
+    db = get_session.return_value.session_factory.return_value.\
+        using_bind.return_value.__enter__.return_value
+    with mock.patch.object(FailedTask, '_backfill_batch',
+                           return_value=(None, 1)), \
+            mock.patch.object(FailedTask, '_merge_duplicates',
+                              return_value=2):
+        assert FailedTask.add_fingerprint_key() == 3
+    statements = [call[0][0].split()[0] for call
+                  in db.connection.return_value.execute.call_args_list]
+    assert statements == ['LOCK', 'ALTER', 'UNLOCK']
+
+
+@mock.patch('walila.model.get_session')
+def test_finish_retry_in_new_session(get_session):
+    scoped = get_session.return_value
+    db = scoped.session_factory.return_value.using_bind.return_value.\
+        __enter__.return_value
+    db.query.return_value.filter.return_value.delete.return_value = 2
+    assert FailedTask.finish_retry([1, 2]) == 2
+    assert not scoped.called
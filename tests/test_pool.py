@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import gevent
+import mock
+import pytest
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import QueuePool
+
+from walila.metrics import Metrics, metrics
+from walila.pool import GreenQueuePool, PoolReaper
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault('pool_size', 2)
+    kwargs.setdefault('max_overflow', 0)
+    return GreenQueuePool(mock.Mock, metric_prefix='test.pool', **kwargs)
+
+
+def test_checkout_timeout():
+    metrics.reset()
+    pool = make_pool(timeout=0.01)
+    conns = [pool.connect(), pool.connect()]
+    with pytest.raises(exc.TimeoutError):
+        pool.connect()
+    assert metrics.counters['test.pool.timeout'] == 1
+    assert metrics.gauges['test.pool.checkedout'] == 2
+    for conn in conns:
+        conn.close()
+
+
+def test_waiters_served_fifo():
+    pool = make_pool(pool_size=1)
+    conn = pool.connect()
+    served = []
+
+    def wait(index):
+        pool.connect().close()
+        served.append(index)
+
+    greenlets = [gevent.spawn(wait, i) for i in range(3)]
+    gevent.sleep(0)
+    conn.close()
+    gevent.joinall(greenlets)
+    assert served == [0, 1, 2]
+
+
+def test_pre_ping_idle_connections():
+    pool = make_pool(pool_size=1, pre_ping_interval=10)
+    with mock.patch('walila.pool.time.time', return_value=100):
+        conn = pool.connect()
+        dbapi_conn = conn.connection
+        conn.close()
+    with mock.patch('walila.pool.time.time', return_value=105):
+        pool.connect().close()
+    assert not dbapi_conn.cursor.called
+
+    dbapi_conn.cursor.return_value.execute.side_effect = RuntimeError
+    with mock.patch('walila.pool.time.time', return_value=200):
+        conn = pool.connect()
+    assert conn.connection is not dbapi_conn
+
+
+def test_pool_reaper():
+    engine = mock.Mock()
+    engine.pool = QueuePool(mock.Mock, pool_size=3, max_overflow=0,
+                            recycle=100)
+    reaper = PoolReaper(engine, 1, min_idle=2)
+    assert reaper.reap() == (0, 2)
+    assert engine.pool.checkedin() == 2
+
+    conn = engine.pool.connect()
+    dbapi_conn = conn.connection
+    starttime = conn._connection_record.starttime
+    conn.close()
+    with mock.patch('walila.pool.time.time', return_value=starttime + 50):
+        assert reaper.reap() == (0, 0)
+    with mock.patch('walila.pool.time.time', return_value=starttime + 90):
+        assert reaper.reap() == (2, 0)
+        assert reaper.reap() == (0, 0)
+    assert engine.pool.checkedin() == 2
+    assert dbapi_conn.close.called
+    conn = engine.pool.connect()
+    assert conn.connection is not dbapi_conn
+    conn.close()
+
+    engine.pool = mock.Mock()
+    assert reaper.reap() == (0, 0)
+
+
+def test_pool_reaper_thread():
+    engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=3)
+    reaper = PoolReaper(engine, 0.01, min_idle=2).start()
+    # reaped without yielding to gevent
+    time.sleep(0.2)
+    assert engine.pool.checkedin() == 2
+
+    # started again by checkouts in a forked process
+    with mock.patch('walila.pool.os.getpid', return_value=-1), \
+            mock.patch('walila.pool.threading.Thread') as thread:
+        engine.connect().close()
+    assert thread.return_value.start.called
+    reaper.stop()
+
+
+def test_pool_reaper_keeps_checkin():
+    engine = mock.Mock()
+    engine.pool = make_pool(pool_size=1, recycle=100, pre_ping_interval=10)
+    with mock.patch('walila.pool.time.time', return_value=100):
+        conn = engine.pool.connect()
+        dbapi_conn = conn.connection
+        conn.close()
+    reaper = PoolReaper(engine, 1)
+    with mock.patch('walila.pool.time.time', return_value=115):
+        assert reaper.reap() == (0, 0)
+    # still idle since 100, pinged
+    with mock.patch('walila.pool.time.time', return_value=120):
+        engine.pool.connect().close()
+    dbapi_conn.cursor.return_value.execute.assert_called_with('SELECT 1')
+
+
+def test_metrics_timer():
+    m = Metrics()
+    for seconds in (0.0005, 0.02, 10):
+        m.timing('t', seconds)
+    timer = m.snapshot()['timers']['t']
+    assert timer['count'] == 3 and timer['max'] == 10
+    buckets = dict(timer['buckets'])
+    assert buckets[0.001] == 1 and buckets[0.05] == 1 and buckets['inf'] == 1
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import pytest
+from sqlalchemy import create_engine, select, text
+
+from walila import prepared
+from walila.prepared import StatementCache, prepared_cursor
+
+
+def make_cache(size):
+    cache = StatementCache(mock.Mock(), size)
+    ids = iter(range(100))
+    cache._prepare = mock.Mock(side_effect=lambda op: {
+        'statement_id': next(ids), 'parameters': []})
+    return cache
+
+
+def test_statement_cache():
+    cache = make_cache(2)
+    assert cache.get('a')['statement_id'] == 0
+    assert cache.get('b')['statement_id'] == 1
+    assert cache.get('a')['statement_id'] == 0
+    # `b` is the least recently used
+    assert cache.get('c')['statement_id'] == 2
+    cache.connection.cmd_stmt_close.assert_called_once_with(1)
+    assert cache.get('b')['statement_id'] == 3
+    assert cache._prepare.call_count == 4
+    assert len(cache) == 2
+
+
+@mock.patch('walila.prepared._get_cursor_class', mock.Mock())
+def test_prepared_cursor():
+    connection = mock.Mock(info={})
+    statements = prepared_cursor(connection, 10).statements
+    assert statements.connection is connection.connection
+    assert prepared_cursor(connection, 10).statements is statements
+    # reconnected
+    connection.connection = mock.Mock()
+    assert prepared_cursor(connection, 10).statements is not statements
+
+
+def test_create_cursor():
+    from walila.db import _mysql_create_cursor as create_cursor
+    context = mock.Mock(execution_options={'prepared_statements': 10})
+    context.compiled.statement = select([text('1')])
+    with mock.patch.object(prepared, 'prepared_cursor') as cursor:
+        assert create_cursor(context) is cursor.return_value
+    cursor.assert_called_once_with(context._dbapi_connection, 10)
+
+    context.compiled.statement = text('SET @a = 1')
+    with mock.patch.object(prepared, 'prepared_cursor') as cursor:
+        create_cursor(context)
+    assert not cursor.called
+
+
+def test_install_mysqlconnector_only():
+    with pytest.raises(ValueError):
+        prepared.install(create_engine('sqlite://'), 10)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import mock
+from sqlalchemy import create_engine
+
+from walila.profiler import QueryProfiler, fingerprint
+
+
+def test_fingerprint():
+    assert fingerprint(
+        "SELECT * FROM foo  WHERE id IN (%s, %s, %s) AND name = 'a''b'\n"
+        "LIMIT 10") == "SELECT * FROM foo WHERE id IN (...) AND name = ? " \
+        "LIMIT ?"
+    assert fingerprint('SELECT 1 WHERE id = %(id_1)s') == \
+        fingerprint('SELECT 2 WHERE id = %(id_2)s')
+
+
+def make_engine(profiler):
+    engine = create_engine('sqlite://', execution_options={'role': 'slave'})
+    profiler.install(engine)
+    return engine
+
+
+def profile_settings(**kwargs):
+    options = dict(DB_SLOW_QUERY_THRESHOLD=0, DB_SLOW_QUERY_TOP_N=10,
+                   DB_EXPLAIN_THRESHOLD=0, DB_N_PLUS_ONE_THRESHOLD=0)
+    options.update(kwargs)
+    return mock.patch('walila.profiler.settings', mock.Mock(**options))
+
+
+@profile_settings(DB_SLOW_QUERY_TOP_N=1, DB_EXPLAIN_THRESHOLD=0.000001)
+def test_slow_queries():
+    profiler = QueryProfiler()
+    engine = make_engine(profiler)
+    with mock.patch.object(profiler, '_explain', return_value=[]) as explain:
+        for i in range(3):
+            engine.execute('SELECT %d' % i)
+    assert explain.call_count == 1
+    slow = profiler.report()['slow_queries']
+    assert len(slow) == 1
+    assert slow[0]['fingerprint'] == 'SELECT ?'
+    assert slow[0]['count'] == 3
+    assert slow[0]['plan'] == []
+
+
+@profile_settings(DB_SLOW_QUERY_TOP_N=1)
+def test_slow_queries_evict_fastest():
+    profiler = QueryProfiler()
+    conn = mock.Mock(_execution_options={})
+    profiler._record_slow(conn, None, 'a', 'a', 1)
+    profiler._record_slow(conn, None, 'b', 'b', 2)
+    assert profiler.slow_queries.keys() == ['b']
+    profiler._record_slow(conn, None, 'a', 'a', 1)
+    assert profiler.slow_queries.keys() == ['b']
+
+
+@profile_settings(DB_SLOW_QUERY_THRESHOLD=10, DB_N_PLUS_ONE_THRESHOLD=3)
+def test_n_plus_one():
+    profiler = QueryProfiler()
+    engine = make_engine(profiler)
+    for i in range(5):
+        engine.execute('SELECT %d' % i)
+    profiler.end_request()
+    engine.execute('SELECT 1')
+    assert profiler.report()['n_plus_one'] == {'SELECT ?': 1}
+    assert profiler._request.counts == {'SELECT ?': 1}
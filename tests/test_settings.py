@@ -1 +1,26 @@
 # -*- coding: utf-8 -*-
+
+from walila.settings import Config
+
+
+def test_number_settings():
+    class MyConfig(object):
+        DB_EXPLAIN_THRESHOLD = 0
+        DB_SLOW_QUERY_THRESHOLD = 2
+        DB_POOL_SIZE = 2.5
+        DB_GATHER_TIMEOUT = 0.5
+        DB_CLOSE_TIMEOUT = 1
+        DB_READ_YOUR_WRITES_WINDOW = 0.5
+        DB_PROFILE = 'yes'
+
+    settings = Config()
+    settings.from_object(MyConfig)
+    # ints are floats, not the other way around
+    assert settings.DB_EXPLAIN_THRESHOLD == 0
+    assert settings.DB_SLOW_QUERY_THRESHOLD == 2
+    assert settings.DB_POOL_SIZE == 10
+    # seconds
+    assert settings.DB_GATHER_TIMEOUT == 0.5
+    assert settings.DB_CLOSE_TIMEOUT == 1
+    assert settings.DB_READ_YOUR_WRITES_WINDOW == 0.5
+    assert settings.DB_PROFILE is False
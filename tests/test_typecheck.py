@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.orm import Session
+
+from walila.db import model_base
+from walila.typecheck import TypeChecker, MODE_OFF, MODE_SAMPLE
+
+ModelBase = model_base()
+
+
+class Bar(ModelBase):
+
+    __tablename__ = 'bar'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20))
+
+
+def make_session():
+    engine = create_engine('sqlite://')
+    ModelBase.metadata.create_all(engine)
+    return Session(bind=engine)
+
+
+def test_strict():
+    checker = TypeChecker()
+    checker.install('strict')
+    try:
+        session = make_session()
+        session.add(Bar(id=1, name='a'))
+        session.add(Bar(id='2', name=3))
+        session.flush()
+        session.query(Bar).filter(Bar.id == '1').all()
+    finally:
+        checker.uninstall()
+    report = checker.report()
+    assert sorted(report) == ['bar.id', 'bar.name']
+    assert report['bar.id']['count'] == 2
+    assert report['bar.id']['value_types'] == ['str']
+    assert report['bar.name']['value_types'] == ['int']
+
+
+def test_off():
+    checker = TypeChecker()
+    origin = Integer.__dict__.get('bind_processor')
+    checker.install(MODE_SAMPLE, sample_rate=0)
+    assert Integer.__dict__.get('bind_processor') is not origin
+    checker.install(MODE_OFF)
+    assert not checker.installed
+    assert Integer.__dict__.get('bind_processor') is origin
+    assert 'coerce_compared_value' not in String.__dict__
+
+
+def test_select_proxies():
+    # columns of selects are attached to them, not to tables
+    query = select([Bar.__table__.c.id]).alias()
+    assert query.c.id.type is Bar.__table__.c.id.type
@@ -1,7 +1,668 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import weakref
+import hashlib
+import contextlib
+import logging
+import functools
+import threading
+import collections
+import cPickle as pickle
+
+import redis
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+_redis = None
+
+
+def get_redis():
+    """Redis client of `CACHE_REDIS_URL`, created lazily but only once"""
+    global _redis
+    if _redis is None:
+        if not settings.CACHE_REDIS_URL:
+            raise RuntimeError("CACHE_REDIS_URL is not configured")
+        _redis = redis.StrictRedis.from_url(settings.CACHE_REDIS_URL)
+    return _redis
+
+
+class LocalCache(object):
+    """Process local LRU cache bounded by size and ttl.
+
+    :param size: max number of keys
+    :param ttl: seconds a key lives
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is _missing:
+                return default
+            value, expire_at = item
+            if expire_at < time.time():
+                return default
+            # move to the most recent end
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        expire_at = time.time() + (ttl or self.ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire_at)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """Run a function only once for concurrent callers of the same key, the
+    others wait for and share its result (or exception)."""
+
+    class _Call(object):
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.exc_info = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.event.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.value
+        try:
+            call.value = func()
+        except BaseException:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value
+
+
+class InvalidationBus(object):
+    """Broadcast keys deleted to the local LRUs of all processes by redis
+    pubsub, so local caches can live long without serving stale data.
+
+    Enabled by `CACHE_INVALIDATION_BUS`. Keys deleted by
+    :meth:`CacheClient.delete` are published to
+    `CACHE_INVALIDATION_CHANNEL`, at most `CACHE_INVALIDATION_BATCH_SIZE`
+    keys a message. Every process subscribes since its first local LRU is
+    created, and evicts the keys from all local LRUs. Local LRUs are cleared
+    after reconnecting as messages may be lost meanwhile.
+    """
+
+    def __init__(self, channel=None, batch_size=None):
+        self._channel = channel
+        self._batch_size = batch_size
+        self._clients = weakref.WeakSet()
+        self._batches = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return settings.CACHE_INVALIDATION_BUS
+
+    @property
+    def channel(self):
+        return self._channel or settings.CACHE_INVALIDATION_CHANNEL
+
+    @property
+    def batch_size(self):
+        return self._batch_size or settings.CACHE_INVALIDATION_BATCH_SIZE
+
+    @property
+    def source(self):
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def register(self, client):
+        self._clients.add(client)
+
+    def evict(self, keys):
+        """Evict full `keys` from local LRUs of this process"""
+        for client in list(self._clients):
+            if client._local is not None:
+                client._local.delete(*keys)
+
+    def evict_all(self):
+        for client in list(self._clients):
+            if client._local is not None:
+                client._local.clear()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Publish keys deleted in the block together when it exits"""
+        if getattr(self._batches, 'keys', None) is not None:
+            yield
+            return
+        self._batches.keys = keys = []
+        try:
+            yield
+        finally:
+            self._batches.keys = None
+            self._send(keys)
+
+    def publish(self, keys):
+        if not self.enabled:
+            return
+        pending = getattr(self._batches, 'keys', None)
+        if pending is not None:
+            pending.extend(keys)
+        else:
+            self._send(keys)
+
+    def _send(self, keys):
+        keys = list(set(keys))
+        if not keys:
+            return
+        source = self.source
+        try:
+            for i in range(0, len(keys), self.batch_size):
+                get_redis().publish(self.channel, json.dumps(
+                    {'source': source, 'keys': keys[i:i + self.batch_size]}))
+        except redis.RedisError:
+            logger.exception("Error publishing invalidation of %r", keys)
+
+    def start(self):
+        """Subscribe in a daemon thread (greenlet if patched), once a
+        process"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            listener = threading.Thread(target=self._listen,
+                                        name='walila-cache-invalidation')
+            listener.daemon = True
+            listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.evict_all()
+                for message in pubsub.listen():
+                    self._handle(message)
+            except Exception:
+                logger.exception("Error listening cache invalidation, "
+                                 "resubscribe in 1s")
+                time.sleep(1)
+
+    def _handle(self, message):
+        if message.get('type') != 'message':
+            return
+        data = json.loads(message['data'])
+        # evicted already when deleting
+        if data.get('source') != self.source:
+            self.evict(data['keys'])
+
+
+invalidation_bus = InvalidationBus()
+
+
+class CacheClient(object):
+    """Two-tier cache: a process local LRU in front of redis.
+
+    Values are pickled, ``None`` is a valid value and is used to cache
+    negative results. Options default to `CACHE_*` settings if ``None``.
+    Keys deleted are evicted from local LRUs of other processes too if
+    :class:`InvalidationBus` is enabled.
+
+    :param prefix: prefix of keys, default `CACHE_KEY_PREFIX`
+    :param ttl: seconds keys live in redis
+    :param negative_ttl: seconds ``None`` results of :meth:`get_or_set`
+                         live, ``0`` not to cache them
+    :param local_size: max keys of the local LRU, ``0`` to disable it
+    :param local_ttl: max seconds keys live in the local LRU
+    :param redis_client: redis client, default :func:`get_redis`
+
+    e.g.
+
+        from walila.cache import cache_client
+
+        cache_client.set_many({'a': 1, 'b': 2}, ttl=60)
+        cache_client.get_many(['a', 'b', 'c'])  # {'a': 1, 'b': 2}
+        cache_client.get_or_set('c', compute_c)
+
+    """
+
+    def __init__(self, prefix=None, ttl=None, negative_ttl=None,
+                 local_size=None, local_ttl=None, redis_client=None):
+        self._prefix = prefix
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._local_size = local_size
+        self._local_ttl = local_ttl
+        self._redis = redis_client
+        self._local = None
+        self._flight = SingleFlight()
+        invalidation_bus.register(self)
+
+    @property
+    def prefix(self):
+        return settings.CACHE_KEY_PREFIX if self._prefix is None \
+            else self._prefix
+
+    @property
+    def ttl(self):
+        return settings.CACHE_TTL if self._ttl is None else self._ttl
+
+    @property
+    def negative_ttl(self):
+        return settings.CACHE_NEGATIVE_TTL if self._negative_ttl is None \
+            else self._negative_ttl
+
+    @property
+    def redis(self):
+        return get_redis() if self._redis is None else self._redis
+
+    @property
+    def local(self):
+        """The local LRU, ``None`` if disabled"""
+        if self._local is None:
+            size = settings.CACHE_LOCAL_SIZE if self._local_size is None \
+                else self._local_size
+            if not size:
+                return None
+            ttl = settings.CACHE_LOCAL_TTL if self._local_ttl is None \
+                else self._local_ttl
+            self._local = LocalCache(size, ttl)
+            invalidation_bus.start()
+        return self._local
+
+    def make_key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def get(self, key, default=None):
+        entry = self._get_entries([key]).get(key)
+        return default if entry is None else entry[0]
+
+    def get_many(self, keys):
+        """Return a dict of ``{key: value}`` of keys cached"""
+        return {key: entry[0]
+                for key, entry in self._get_entries(keys).iteritems()}
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        """Set keys of `mapping` by a redis pipeline"""
+        self._set_entries(mapping, ttl or self.ttl)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        full_keys = [self.make_key(key) for key in keys]
+        local = self.local
+        if local is not None:
+            local.delete(*full_keys)
+        try:
+            self.redis.delete(*full_keys)
+        except redis.RedisError:
+            logger.exception("Error deleting caches %r", full_keys)
+        invalidation_bus.publish(full_keys)
+
+    def get_or_set(self, key, func, ttl=None, negative_ttl=None, beta=1.0):
+        """Get `key`, or set it to ``func()`` if missing.
+
+        Concurrent misses in this process call `func` only once, and
+        caches about to expire are recomputed early by probability (the
+        longer `func` takes and the greater `beta` is, the earlier) so
+        processes rarely miss at the same time.
+        """
+        entry = self._get_entries([key]).get(key)
+        if entry is not None and not self._should_recompute(entry, beta):
+            return entry[0]
+        return self._flight.do(
+            key, lambda: self._compute(key, func, ttl, negative_ttl))
+
+    def _compute(self, key, func, ttl, negative_ttl):
+        start = time.time()
+        value = func()
+        delta = time.time() - start
+        if value is None:
+            ttl = self.negative_ttl if negative_ttl is None else negative_ttl
+            if not ttl:
+                return value
+        self._set_entries({key: value}, ttl or self.ttl, delta)
+        return value
+
+    @staticmethod
+    def _should_recompute(entry, beta):
+        _, expire_at, delta = entry
+        if not delta or not beta:
+            return False
+        # XFetch, see "Optimal Probabilistic Cache Stampede Prevention"
+        return time.time() - delta * beta * math.log(1 - random.random()) \
+            >= expire_at
+
+    def _get_entries(self, keys):
+        entries = {}
+        missing = []
+        local = self.local
+        for key in keys:
+            full_key = self.make_key(key)
+            entry = local.get(full_key) if local is not None else None
+            if entry is None:
+                missing.append((key, full_key))
+            else:
+                entries[key] = entry
+        if not missing:
+            return entries
+        full_keys = [item[1] for item in missing]
+        try:
+            raws = self.redis.mget(full_keys)
+        except redis.RedisError:
+            logger.exception("Error getting caches %r", full_keys)
+            return entries
+        for (key, full_key), raw in zip(missing, raws):
+            if raw is None:
+                continue
+            entry = pickle.loads(raw)
+            entries[key] = entry
+            self._set_local(full_key, entry)
+        return entries
+
+    def _set_entries(self, mapping, ttl, delta=0):
+        if not mapping:
+            return
+        expire_at = time.time() + ttl
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in mapping.iteritems():
+                entry = (value, expire_at, delta)
+                full_key = self.make_key(key)
+                pipe.setex(full_key, int(math.ceil(ttl)),
+                           pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+                self._set_local(full_key, entry)
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception("Error setting caches %r", mapping.keys())
+
+    def _set_local(self, full_key, entry):
+        local = self.local
+        if local is None:
+            return
+        ttl = min(local.ttl, entry[1] - time.time())
+        if ttl > 0:
+            local.set(full_key, entry, ttl)
+
+
+cache_client = CacheClient()
+
+
+def _hash_args(args, kwargs):
+    return hashlib.sha1(repr((args, sorted(kwargs.items())))).hexdigest()
+
+
+def cached(ttl=None, key=None, negative_ttl=None, client=None):
+    """Cache results of the decorated function by
+    :meth:`CacheClient.get_or_set`.
+
+    :param key: a format string of the arguments or a function of them
+                returning the key, default module, name and hash of the
+                arguments
+    :param client: default :data:`cache_client`
+
+    e.g.
+
+        @cached(ttl=60, key='user:{0}')
+        def get_user(user_id):
+            ...
+
+        get_user(1)
+        get_user.invalidate(1)
+
+    """
+    def decorator(func):
+        def make_key(*args, **kwargs):
+            if key is None:
+                return '%s.%s:%s' % (func.__module__, func.__name__,
+                                     _hash_args(args, kwargs))
+            if callable(key):
+                return key(*args, **kwargs)
+            return key.format(*args, **kwargs)
+
+        def get_client():
+            return cache_client if client is None else client
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_client().get_or_set(
+                make_key(*args, **kwargs), lambda: func(*args, **kwargs),
+                ttl=ttl, negative_ttl=negative_ttl)
+
+        def invalidate(*args, **kwargs):
+            get_client().delete(make_key(*args, **kwargs))
+
+        wrapper.make_key = make_key
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
 
 class CacheMixinBase(object):
+    """Base of model cache mixins, :class:`walila.db.ModelMeta` registers
+    models directly inheriting it to their `_hook`."""
+
+
+class ModelCacheHook(object):
+    """Invalidate caches of registered models after sessions commit.
+
+    Instances flushed (inserted, updated or deleted) are collected on
+    ``after_flush``, their caches are invalidated on ``after_commit``, and
+    forgotten on rollback. NOTE: bulk ``query.update()`` and
+    ``query.delete()`` are not tracked.
     """
-    TODO: CacheMixin ^_^
+
+    INFO_KEY = 'walila_cache_pending'
+
+    def __init__(self):
+        self.models = set()
+        self._listening = False
+
+    def add(self, model):
+        # NOTE: called before the model is mapped
+        self.models.add(model)
+        if not self._listening:
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_soft_rollback', self._after_rollback)
+            self._listening = True
+
+    def _after_flush(self, session, flush_context):
+        pending = None
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            model = type(obj)
+            if model not in self.models:
+                continue
+            if pending is None:
+                pending = session.info.setdefault(self.INFO_KEY, set())
+            pk = inspect(model).primary_key_from_instance(obj)[0]
+            if pk is not None:
+                pending.add((model, pk))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(self.INFO_KEY, None)
+        if not pending:
+            return
+        pks = collections.defaultdict(list)
+        for model, pk in pending:
+            pks[model].append(pk)
+        with invalidation_bus.batch():
+            for model, model_pks in pks.iteritems():
+                model.invalidate(*model_pks)
+
+    def _after_rollback(self, session, previous_transaction):
+        # changes of savepoints rolled back are still invalidated, it's safe
+        if previous_transaction.parent is None:
+            session.info.pop(self.INFO_KEY, None)
+
+
+model_cache_hook = ModelCacheHook()
+
+
+class CacheMixin(CacheMixinBase):
+    """Cache model instances by primary key in redis, optionally in a local
+    LRU in front of it. Caches are invalidated after sessions commit.
+
+    e.g.
+
+        class Foo(ModelBase, CacheMixin):
+            __tablename__ = 'foo'
+            __db__ = 'walila'  # name in `DB_SETTINGS` to load misses
+
+        Foo.get(1)
+        Foo.mget([1, 2, 3])
+
+    Instances got are detached, ``session.merge(foo, load=False)`` to attach
+    them to a session.
+
+    Local LRUs of other processes are only invalidated with
+    `CACHE_INVALIDATION_BUS` enabled, keep `__cache_local_ttl__` short
+    without it.
     """
+
+    _hook = model_cache_hook
+
+    __db__ = None
+    __cache_ttl__ = 3600
+    # seconds pks not found are cached, `0` not to cache them
+    __cache_negative_ttl__ = 0
+    __cache_local_size__ = 0
+    __cache_local_ttl__ = 5
+
+    @classmethod
+    def _cache(cls):
+        client = cls.__dict__.get('_cache_client')
+        if client is None:
+            client = CacheClient(
+                prefix='%s:%s' % (settings.CACHE_KEY_PREFIX,
+                                  cls.__tablename__),
+                ttl=cls.__cache_ttl__,
+                negative_ttl=cls.__cache_negative_ttl__,
+                local_size=cls.__cache_local_size__,
+                local_ttl=cls.__cache_local_ttl__)
+            cls._cache_client = client
+        return client
+
+    @classmethod
+    def _pk_column(cls):
+        columns = cls.__table__.primary_key.columns.values()
+        assert len(columns) == 1, \
+            "Only models with single column primary key can be cached"
+        return columns[0]
+
+    @classmethod
+    def _dump(cls, obj):
+        return {attr.key: getattr(obj, attr.key)
+                for attr in inspect(cls).column_attrs}
+
+    @classmethod
+    def _load(cls, data):
+        obj = cls()
+        for key, value in data.iteritems():
+            setattr(obj, key, value)
+        make_transient_to_detached(obj)
+        return obj
+
+    @classmethod
+    def get(cls, pk):
+        # concurrent misses of a pk load it from db only once
+        data = cls._cache().get_or_set(
+            pk, lambda: cls._get_from_db(pk))
+        return None if data is None else cls._load(data)
+
+    @classmethod
+    def mget(cls, pks):
+        """Get instances of `pks`, return a dict of ``{pk: instance}``
+        without the ones not found."""
+        cache = cls._cache()
+        found = cache.get_many(pks)
+        missing = [pk for pk in pks if pk not in found]
+        if missing:
+            fetched = cls._mget_from_db(missing)
+            cache.set_many(fetched)
+            if cls.__cache_negative_ttl__:
+                cache.set_many({pk: None for pk in missing
+                                if pk not in fetched},
+                               ttl=cls.__cache_negative_ttl__)
+            found.update(fetched)
+        return {pk: cls._load(data) for pk, data in found.iteritems()
+                if data is not None}
+
+    @classmethod
+    def _db_session(cls):
+        # a new session on master: the caller's may hold uncommitted changes
+        # and read from replicas lagging behind the invalidations
+        from .db import db_manager
+        scoped = db_manager.get_session(cls.__db__)
+        return scoped.session_factory().using_bind('master')
+
+    @classmethod
+    def _get_from_db(cls, pk):
+        with cls._db_session() as session:
+            # baked if `DB_BAKED_QUERIES`
+            obj = session.query(cls).get(pk)
+            return None if obj is None else cls._dump(obj)
+
+    @classmethod
+    def _mget_from_db(cls, pks):
+        pk_column = cls._pk_column()
+        with cls._db_session() as session:
+            objs = session.query(cls).filter(pk_column.in_(pks)).all()
+            return {getattr(obj, pk_column.key): cls._dump(obj)
+                    for obj in objs}
+
+    @classmethod
+    def invalidate(cls, *pks):
+        """Delete caches of `pks`"""
+        cls._cache().delete(*pks)
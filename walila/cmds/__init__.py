@@ -4,6 +4,7 @@ import click
 
 from .serve import serve
 from .consumer import consume
+from .retry import retry
 
 
 @click.group()
@@ -14,3 +15,4 @@ def walila():
 
 walila.add_command(serve)
 walila.add_command(consume)
+walila.add_command(retry)
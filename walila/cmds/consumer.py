@@ -1,40 +1,151 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import errno
+import signal
 import socket
 import click
 
 from ..config import load_env_config, load_app_config
+from ..consts import (
+    WORKER_POOLS,
+    GREEN_WORKER_POOLS,
+    DEFAULT_WORKER_POOL,
+    DEFAULT_GREEN_WORKER_CONCURRENCY,
+)
+from ..utils import get_cpu_count
 from .utils import _validate_env
 
 
+def _derive_concurrency(pool, nworkers, process_num):
+    """Green pools run one greenlet pool per cpu by default, while prefork
+    pool forks one process per cpu by itself.
+
+    :return: ``(nworkers, process_num)``
+    """
+    if pool in GREEN_WORKER_POOLS:
+        return (nworkers or DEFAULT_GREEN_WORKER_CONCURRENCY,
+                process_num or get_cpu_count())
+    return nworkers or get_cpu_count(), process_num or 1
+
+
+def _forward_signal(children, sig):
+    # a Ctrl+C also reaches children of the terminal's process group, and
+    # celery cold shuts down on a second SIGINT, killing running tasks, so
+    # it's forwarded as SIGTERM, a warm shutdown however many times received
+    if sig == signal.SIGINT:
+        sig = signal.SIGTERM
+    for pid in children:
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+
+def _run_processes(target, process_num):
+    """Fork `process_num` processes running ``target(index)``, forward stop
+    signals to them and wait until all of them exit.
+
+    :return: the first non-zero exit code of them, or 0
+    """
+    stop_signals = (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT)
+    children = []
+
+    def forward(sig, frame):
+        _forward_signal(children, sig)
+
+    # installed before forking, so no signal is lost between forks
+    handlers = {sig: signal.signal(sig, forward) for sig in stop_signals}
+    try:
+        for index in range(process_num):
+            pid = os.fork()
+            if pid == 0:
+                for sig in stop_signals:
+                    signal.signal(sig, signal.SIG_DFL)
+                code = 0
+                try:
+                    target(index)
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else 1
+                except BaseException:
+                    code = 1
+                os._exit(code)
+            children.append(pid)
+
+        status = 0
+        while children:
+            try:
+                pid, code = os.wait()
+            except OSError as e:
+                # interrupted by the signals forwarded, children are still
+                # shutting down
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid in children:
+                children.remove(pid)
+                status = status or os.WEXITSTATUS(code)
+        return status
+    finally:
+        for sig, handler in handlers.iteritems():
+            signal.signal(sig, handler)
+
+
 @click.command()
 @click.argument("app", required=True)
-@click.option("-w", "--nworkers", type=int, default=1,
-              help="Number of workers")
-@click.option("-p", "--process_num", type=int, default=1,
-              help="Number of processes to run celery worker")
+@click.option("-P", "--pool", type=click.Choice(WORKER_POOLS),
+              default=DEFAULT_WORKER_POOL,
+              help="Worker pool, `prefork` for cpu-bound queues, "
+                   "`gevent`/`eventlet` for io-bound queues")
+@click.option("-w", "--nworkers", type=int, default=None,
+              help="Concurrency of each process, default cpu count for "
+                   "prefork, %d for green pools"
+                   % DEFAULT_GREEN_WORKER_CONCURRENCY)
+@click.option("-p", "--process_num", type=int, default=None,
+              help="Number of processes to run celery worker, default 1 for "
+                   "prefork, cpu count for green pools")
+@click.option("--autoscale", type=str, default=None,
+              help="`MAX,MIN` concurrency of each process, scale the pool by "
+                   "queue depth, see `walila.queue.autoscale`")
 @click.option('--environment', type=str, default=load_env_config().env,
               help='current environment', callback=_validate_env)
-def consume(app, nworkers, process_num, environment):
+def consume(app, pool, nworkers, process_num, autoscale, environment):
 
     load_env_config().set_currnet_env(environment)
     queue_names = load_app_config().async_queues
+    nworkers, process_num = _derive_concurrency(pool, nworkers, process_num)
 
-    def celery_worker():
-        from celery.bin.celery import main
+    def celery_worker(index=None):
+        import celery
         from ..env import initialize, is_in_dev
 
-        initialize()
-
         hostname = socket.gethostname()
+        node_name = queue_names
+        if index is not None:
+            node_name = "%s-%d" % (queue_names, index)
 
         argv = ["celery", "worker", "-l", "INFO", "-A", app,
-                "-c", str(nworkers), "-Q", queue_names, "-E",
-                "-n", "%s@%s" % (queue_names, hostname), "--without-heartbeat",
+                "-P", pool, "-c", str(nworkers), "-Q", queue_names, "-E",
+                "-n", "%s@%s" % (node_name, hostname), "--without-heartbeat",
                 "--without-gossip", "--without-mingle"]
+        if autoscale:
+            argv.append("--autoscale=%s" % autoscale)
         if not is_in_dev():
             argv.extend(["-f", load_app_config().task_log_path])
+
+        # green pools must be patched before anything else is initialized
+        celery.maybe_patch_concurrency(argv)
+        from celery.bin.celery import main
+        # prefork pool processes warm up their own connections after forked,
+        # see `walila.queue.async.warm_up_pool_process`
+        initialize(warm_up=pool != 'prefork')
+        if autoscale:
+            from ..queue.autoscale import install_autoscaler  # noqa
         main(argv)
 
+    if process_num > 1:
+        sys.exit(_run_processes(celery_worker, process_num))
     sys.exit(celery_worker())
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ..config import load_env_config
+from .utils import _validate_env
+
+
+@click.command("retry")
+@click.argument("app", required=True)
+@click.option("-b", "--batch_size", type=int, default=500,
+              help="Number of failed tasks loaded per batch")
+@click.option("-c", "--concurrency", type=int, default=20,
+              help="Number of tasks dispatched concurrently")
+@click.option("-n", "--name", multiple=True,
+              help="Only retry tasks of this name, can be repeated")
+@click.option("--mark", is_flag=True, default=False,
+              help="Mark retried tasks as no need to retry, not delete them")
+@click.option('--environment', type=str, default=load_env_config().env,
+              help='current environment', callback=_validate_env)
+def retry(app, batch_size, concurrency, name, mark, environment):
+    """Replay failed tasks recorded by `RecordErrorsTask`, APP is the module
+    where tasks are registered."""
+    from gevent import monkey
+    monkey.patch_all()
+
+    from importlib import import_module
+    from ..env import initialize
+
+    load_env_config().set_currnet_env(environment)
+    initialize()
+    import_module(app)
+
+    from ..queue.retry import FailedTaskRetrier
+    retrier = FailedTaskRetrier(batch_size=batch_size,
+                                concurrency=concurrency,
+                                delete=not mark,
+                                names=name or None)
+    dispatched, skipped = retrier.run()
+    click.echo("Retried: %d, skipped: %d" % (dispatched, skipped))
@@ -12,6 +12,12 @@ DEFAULT_ENV = 'dev'
 
 DEFAULT_WORKER_NUM = 1
 
+# celery worker pools
+WORKER_POOLS = ('prefork', 'gevent', 'eventlet', 'solo')
+GREEN_WORKER_POOLS = ('gevent', 'eventlet')
+DEFAULT_WORKER_POOL = 'prefork'
+DEFAULT_GREEN_WORKER_CONCURRENCY = 1000
+
 # env
 ENV_DEV = 'dev'
 ENV_TESTING = 'testing'
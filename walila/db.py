@@ -1,59 +1,49 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import zlib
+import bisect
+import Queue
 import functools
+import itertools
+import collections
+import contextlib
 import random
 import uuid
 import logging
+import threading
+import weakref
 
 import gevent
+from gevent import monkey
 from sqlalchemy import create_engine as sqlalchemy_create_engine
-from sqlalchemy import types
-from sqlalchemy.types import Integer, String
-from sqlalchemy.orm import Session, scoped_session, sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import types, inspect
+from sqlalchemy.types import Integer
+from sqlalchemy.orm import Query, Session, scoped_session, sessionmaker
+from sqlalchemy.orm.query import _MapperEntity
+from sqlalchemy.ext import baked
+from sqlalchemy.util import ScopedRegistry, LRUCache
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import _generative
+from sqlalchemy.dialects.mysql.base import MySQLExecutionContext
 from sqlalchemy.sql.expression import (
-    Executable, ClauseElement, Insert, _literal_as_text)
+    Executable, ClauseElement, Insert, UpdateBase, Selectable,
+    _literal_as_text, text)
 
 from .settings import settings
+from .typecheck import type_checker, MODE_STRICT
+from .metrics import metrics
+from .writebehind import WriteBehindBuffer
 
+COMPILED_CACHE_SIZE = 500
 
-def patch_column_type_checker():
-    def coerce_compared_value(self, op, value):
-        return self
-
-    def predicate_type(types):
-        def wrapper(func):
-            @functools.wraps(func)
-            def bind_processor(*args, **kwds):
-                processor = func(*args, **kwds)
-                if processor is None:
-                    def validator(value):
-                        if not isinstance(value, types):
-                            raise TypeError("ONLY IN DEV: Column type defined"
-                                            " in model: %s, Got: %s"
-                                            % (types, type(value)))
-                        return value
-                else:
-                    def validator(value):
-                        res = processor(value)
-                        if not isinstance(res, types):
-                            raise TypeError("ONLY IN DEV: Column type defined"
-                                            " in model: %s, Got: %s"
-                                            % (types, type(value)))
-                        return res
-                return validator
-            return bind_processor
-        return wrapper
 
-    Integer.coerce_compared_value = coerce_compared_value
-    Integer.bind_processor = predicate_type((int, long))(
-        Integer.bind_processor
-        )
-
-    String.coerce_compared_value = coerce_compared_value
-    String.bind_processor = predicate_type(basestring)(String.bind_processor)
+def patch_column_type_checker():
+    """Deprecated, use :data:`walila.typecheck.type_checker`"""
+    type_checker.install(MODE_STRICT)
 
 
 class StrongInteger(types.TypeDecorator):
@@ -75,6 +65,9 @@ class TaskHashMixin(object):
 
 
 class UpsertMixin(object):
+    # name in `DB_SETTINGS` of the db `bulk_upsert` writes to by default
+    __db__ = None
+
     @classmethod
     def upsert(cls):
         """Build :class:`zeus_core.db.Upsert` statement.
@@ -89,6 +82,168 @@ class UpsertMixin(object):
         """
         return Upsert(cls.__table__)
 
+    @classmethod
+    def cached_upsert(cls, update_columns=None, increment_columns=None):
+        """Shared upsert statement to be executed with parameters instead of
+        `values()`, by :func:`execute_cached` it is compiled once for every
+        set of keys. e.g.::
+
+            execute_cached(db, Foo.cached_upsert(), {'name': name})
+
+        :param update_columns: see :meth:`Upsert.update_only`
+        :param increment_columns: columns increased by the values on
+         duplicate key, instead of set to
+        """
+        update_keys = increment_keys = None
+        if update_columns is not None:
+            update_keys = frozenset(update_columns)
+        if increment_columns is not None:
+            increment_keys = frozenset(increment_columns)
+        key = (cls.__table__, update_keys, increment_keys)
+        stmt = _cached_stmts.get(key)
+        if stmt is None:
+            stmt = cls.upsert()
+            if update_keys is not None:
+                stmt = stmt.update_only(*update_keys)
+            if increment_keys:
+                names = [cls.__table__.c[k].name for k in increment_keys]
+                # counters of NULL are increased from 0
+                stmt = stmt.on_duplicate(**{
+                    name: 'COALESCE(%s, 0) + VALUES(%s)' % (name, name)
+                    for name in names})
+            _cached_stmts[key] = stmt
+        return stmt
+
+    @classmethod
+    def bulk_upsert(cls, rows, chunk_size=None, update_columns=None,
+                    session=None, increment_columns=None):
+        """Upsert `rows` in chunks within one transaction on master.
+
+        Rows of the same keys are executed together by ``executemany``, so
+        the statement of each shape is compiled once and cached, in chunks
+        of at most `chunk_size` (default `DB_BULK_UPSERT_CHUNK_SIZE`) rows
+        and about `DB_MAX_ALLOWED_PACKET` bytes.
+
+        :param rows: list of dict of column keys
+        :param update_columns: columns updated on duplicate key, default all
+         the columns of rows
+        :param session: scoped session, default the one of `__db__`, rows
+         are upserted and committed by a new session of it, not the one of
+         the caller's scope
+        :param increment_columns: see :meth:`cached_upsert`
+        :return: affected rows counted by mysql, 1 for every row inserted
+         and 2 for every row updated
+        """
+        if not rows:
+            return 0
+        if session is None:
+            session = db_manager.get_session(cls.__db__)
+        stmt = cls.cached_upsert(update_columns, increment_columns)
+        chunks = _chunk_rows(rows,
+                             chunk_size or settings.DB_BULK_UPSERT_CHUNK_SIZE,
+                             settings.DB_MAX_ALLOWED_PACKET)
+        affected = 0
+        # closed on exit
+        with session.session_factory().using_bind('master') as db:
+            for chunk in chunks:
+                affected += execute_cached(db, stmt, chunk).rowcount
+        return affected
+
+
+def _chunk_rows(rows, chunk_size, max_bytes):
+    """Group `rows` by keys, and split the groups into chunks of at most
+    `chunk_size` rows and about `max_bytes` bytes of values."""
+    shapes = collections.OrderedDict()
+    for row in rows:
+        shapes.setdefault(tuple(sorted(row)), []).append(row)
+    for shape_rows in shapes.itervalues():
+        chunk, size = [], 0
+        for row in shape_rows:
+            # a rough estimate, leaves room for the statement itself
+            row_size = sum(len(repr(v)) + 2 for v in row.itervalues())
+            if chunk and (len(chunk) >= chunk_size or
+                          size + row_size > max_bytes * 0.9):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield chunk
+
+
+class CounterBuffer(WriteBehindBuffer):
+    """Write-behind increments of counter columns of :class:`UpsertMixin`
+    models, e.g.::
+
+        counter_buffer.incr(Post, post.id, views=1)
+
+    Increments are summed up in memory by model, primary key and column,
+    then flushed in background every `flush_interval` seconds or when
+    `buffer_size` counters are buffered, with one
+    :meth:`UpsertMixin.bulk_upsert` per model adding them to the columns.
+    Rows missing are inserted with the increments, so other columns of them
+    should be nullable or have server defaults. Buffered increments are
+    flushed on worker shutdown.
+
+    :param flush_interval: seconds between two flushes, default
+     `DB_COUNTER_FLUSH_INTERVAL`
+    :param buffer_size: max distinct counters buffered before flushing,
+     default `DB_COUNTER_BUFFER_SIZE`
+    """
+
+    name = 'counter'
+    FLUSH_INTERVAL_SETTING = 'DB_COUNTER_FLUSH_INTERVAL'
+    BUFFER_SIZE_SETTING = 'DB_COUNTER_BUFFER_SIZE'
+
+    def incr(self, model, pk, **increments):
+        for column, value in increments.iteritems():
+            self._put((model, pk, column), value)
+
+    def _merge(self, old, new):
+        return old + new
+
+    def _groups(self, items):
+        by_model = collections.defaultdict(dict)
+        for key, value in items.iteritems():
+            by_model[key[0]][key] = value
+        return by_model.values()
+
+    def _save(self, items):
+        model = next(iter(items))[0]
+        pk_key = inspect(model).primary_key[0].key
+        rows = {}
+        for (_, pk, column), value in items.iteritems():
+            rows.setdefault(pk, {pk_key: pk})[column] = value
+        increment_columns = set(column for _, _, column in items)
+        model.bulk_upsert(rows.values(), increment_columns=increment_columns)
+        logger.info("Saved %d counters of %s", len(items), model.__name__)
+        return len(items)
+
+
+counter_buffer = CounterBuffer()
+
+
+# compiled forms of statements executed by `execute_cached`, keyed by the
+# statement objects, so only statements shared between executions hit, e.g.
+# the ones of `UpsertMixin.cached_upsert`
+_compiled_cache = LRUCache(COMPILED_CACHE_SIZE)
+_cached_stmts = LRUCache(COMPILED_CACHE_SIZE)
+_ondup_updates_cache = LRUCache(COMPILED_CACHE_SIZE)
+# baked queries and their compiled statements, see `RoutingQuery.get`
+_bakery = baked.bakery(COMPILED_CACHE_SIZE)
+
+
+def execute_cached(session, stmt, params=None):
+    """Execute `stmt` in `session` with its compiled form cached, for
+    statements shared between executions, e.g.::
+
+        execute_cached(db, Foo.cached_upsert(), rows)
+
+    """
+    conn = session.connection(clause=stmt).execution_options(
+        compiled_cache=_compiled_cache)
+    return conn.execute(stmt, params)
+
 
 class Explain(Executable, ClauseElement):
     def __init__(self, stmt, analyze=False):
@@ -97,7 +252,25 @@ class Explain(Executable, ClauseElement):
 
 
 class Upsert(Insert):
-    pass
+    _ondup_exprs = None
+    _update_keys = None
+
+    @_generative
+    def on_duplicate(self, **exprs):
+        """Override the ``ON DUPLICATE KEY UPDATE`` expression of columns,
+        which is ``col = VALUES(col)`` by default.
+
+        Example::
+
+            Foo.upsert().values(rows).on_duplicate(
+                hits='hits + VALUES(hits)')
+        """
+        self._ondup_exprs = dict(self._ondup_exprs or {}, **exprs)
+
+    @_generative
+    def update_only(self, *names):
+        """Only update columns of `names` on duplicate key"""
+        self._update_keys = frozenset(names)
 
 
 @compiles(Explain, 'mysql')
@@ -109,26 +282,52 @@ def mysql_explain(element, compiler, **kw):
     return text
 
 
+def _ondup_expr(compiler, exprs, name):
+    expr = exprs.get(name)
+    if expr is None:
+        return 'VALUES(%s)' % name
+    if isinstance(expr, basestring):
+        return expr
+    return compiler.process(expr)
+
+
 @compiles(Upsert, 'mysql')
 def mysql_upsert(insert_stmt, compiler, **kwargs):
-    # A modified version of https://gist.github.com/timtadh/7811458.
-    # The license (3-Clause BSD) is in the repository root.
     parameters = insert_stmt.parameters
     if insert_stmt._has_multi_parameters:
         parameters = parameters[0]
-    keys = list(parameters or {})
+    # keys of the parameters passed to execute if values are not given
+    keys = frozenset(parameters or compiler.column_keys or ())
+    insert = compiler.visit_insert(insert_stmt, **kwargs)
+    return ' '.join((insert, 'ON DUPLICATE KEY UPDATE',
+                     _ondup_updates(insert_stmt, compiler, keys)))
+
+
+def _ondup_updates(insert_stmt, compiler, keys):
+    exprs = insert_stmt._ondup_exprs or {}
+    # clauses may carry binds, which must be processed every time
+    cache_key = None
+    if all(isinstance(expr, basestring) for expr in exprs.itervalues()):
+        cache_key = (insert_stmt.table, keys, insert_stmt._update_keys,
+                     frozenset(exprs.iteritems()))
+        updates = _ondup_updates_cache.get(cache_key)
+        if updates is not None:
+            return updates
+
+    # A modified version of https://gist.github.com/timtadh/7811458.
+    # The license (3-Clause BSD) is in the repository root.
+    keys = set(keys)
     pk = insert_stmt.table.primary_key
     auto = None
     if (len(pk.columns) == 1 and
             isinstance(pk.columns.values()[0].type, Integer) and
             pk.columns.values()[0].autoincrement):
         auto = pk.columns.keys()[0]
-        if auto in keys:
-            keys.remove(auto)
-    insert = compiler.visit_insert(insert_stmt, **kwargs)
-    ondup = 'ON DUPLICATE KEY UPDATE'
+        keys.discard(auto)
+    if insert_stmt._update_keys is not None:
+        keys &= insert_stmt._update_keys
     updates = ', '.join(
-        '%s = VALUES(%s)' % (c.name, c.name)
+        '%s = %s' % (c.name, _ondup_expr(compiler, exprs, c.name))
         for c in insert_stmt.table.columns
         if c.name in keys
     )
@@ -138,8 +337,14 @@ def mysql_upsert(insert_stmt, compiler, **kwargs):
             updates = ', '.join((last_id, updates))
         else:
             updates = last_id
-    upsert = ' '.join((insert, ondup, updates))
-    return upsert
+    elif not updates:
+        # nothing to update, but the clause can not be empty
+        name = pk.columns.values()[0].name
+        updates = '%s = %s' % (name, name)
+
+    if cache_key is not None:
+        _ondup_updates_cache[cache_key] = updates
+    return updates
 
 
 def close_connections(engines, transactions):
@@ -152,16 +357,384 @@ def close_connections(engines, transactions):
                     conn.invalidate()
 
 
+def _engine_option(engine, name, default):
+    options = getattr(engine, '_execution_options', None) or {}
+    return options.get(name, default)
+
+
+def _metric_prefix(engine):
+    return 'db.%s.%s' % (_engine_option(engine, 'db', 'default'),
+                         _engine_option(engine, 'role', 'default'))
+
+
+class ConnectionQuarantine(object):
+    """Clean up connections of sessions timed out rolling back or closing
+    in background threads (greenlets if patched), instead of invalidating
+    them inline.
+
+    Every connection is rolled back and checked by a round trip within
+    `DB_QUARANTINE_TIMEOUT` seconds, returned to its pool if it's healthy,
+    or invalidated if not. Recorded to :data:`walila.metrics.metrics` as
+    ``db.<db>.<role>.quarantine.recovered|invalidated``.
+
+    :param concurrency: connections cleaned at the same time, default
+     `DB_QUARANTINE_CONCURRENCY`
+    """
+
+    def __init__(self, concurrency=None):
+        self._concurrency = concurrency
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self):
+        return self._concurrency or settings.DB_QUARANTINE_CONCURRENCY
+
+    def put(self, transaction):
+        """Quarantine connections of the root session `transaction`, which
+        must not be used by its session anymore"""
+        if not transaction._connections:
+            return
+        self._ensure_worker()
+        for conn, trans, autoclose in set(transaction._connections.values()):
+            if conn.closed:
+                continue
+            metrics.incr(_metric_prefix(conn.engine) + '.quarantine')
+            self._queue.put((conn, trans, autoclose))
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue()
+            # a connection hanging up to the timeout doesn't hold up others
+            for i in range(self.concurrency):
+                worker = threading.Thread(
+                    target=self._work, name='walila-db-quarantine-%d' % i)
+                worker.daemon = True
+                worker.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while 1:
+            self.clean(*self._queue.get())
+
+    def clean(self, conn, trans, autoclose):
+        prefix = _metric_prefix(conn.engine)
+        try:
+            with gevent.Timeout(settings.DB_QUARANTINE_TIMEOUT):
+                # the ones interrupted may have responses not read, which
+                # must not be read by the next queries
+                trans.close()
+                nonce = random.randint(1, 1 << 30)
+                cursor = conn.connection.cursor()
+                try:
+                    cursor.execute('SELECT %d' % nonce)
+                    row = cursor.fetchone()
+                finally:
+                    cursor.close()
+                if not row or row[0] != nonce:
+                    raise ValueError("Got %r instead of %d" % (row, nonce))
+        except BaseException as e:
+            logger.warning("Invalidate connection quarantined of %s: %r",
+                           prefix, e)
+            metrics.incr(prefix + '.quarantine.invalidated')
+            try:
+                conn.invalidate(e)
+            except Exception:
+                logger.exception("Error invalidating connection")
+        else:
+            metrics.incr(prefix + '.quarantine.recovered')
+        if autoclose:
+            try:
+                conn.close()
+            except Exception:
+                logger.exception("Error closing connection")
+
+
+connection_quarantine = ConnectionQuarantine()
+
+
+class ReplicaStat(object):
+    """Health of a slave engine sampled by :class:`ReplicaTracker`"""
+
+    def __init__(self):
+        self.healthy = True
+        self.lag = 0
+        self.latency = None
+        self.sampled_at = None
+
+    def __repr__(self):
+        return "<ReplicaStat healthy={!r} lag={!r} latency={!r}>".format(
+            self.healthy, self.lag, self.latency)
+
+
+# errors of `SHOW SLAVE STATUS` by replicas reachable: no privilege of
+# REPLICATION CLIENT, access denied, syntax error and not supported
+_LAG_UNAVAILABLE_ERRORS = (1227, 1142, 1064, 1235)
+
+
+def _is_lag_unavailable(error):
+    if isinstance(error, ProgrammingError):
+        return True
+    args = getattr(error.orig, 'args', None)
+    return bool(args) and args[0] in _LAG_UNAVAILABLE_ERRORS
+
+
+class ReplicaTracker(object):
+    """Sample replication lag and latency of slave engines in a background
+    thread (greenlet if patched), and choose slave engines by them.
+
+    The thread is started again in processes forked, e.g. prefork pool
+    processes of celery.
+
+    :param engines: slave engines to track
+    :param interval: seconds between two samples
+    :param max_lag: replicas lagging more seconds than this are unhealthy
+    """
+
+    LATENCY_DECAY = 0.3
+
+    def __init__(self, engines, interval, max_lag):
+        self.engines = list(engines)
+        self.interval = interval
+        self.max_lag = max_lag
+        self.stats = {engine: ReplicaStat() for engine in self.engines}
+        self._lag_unavailable = set()
+        self._down = set()
+        self._running = False
+        self._stopped = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._running = True
+        self._ensure_worker()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._stopped is not None:
+            self._stopped.set()
+        self._pid = None
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._stopped is not None:
+                # of the parent process, or stopped already
+                self._stopped.set()
+            self._stopped = threading.Event()
+            worker = threading.Thread(target=self._sample_forever,
+                                      args=(self._stopped,),
+                                      name='walila-replica-tracker')
+            worker.daemon = True
+            worker.start()
+            self._pid = os.getpid()
+
+    def _sample_forever(self, stopped):
+        while not stopped.is_set():
+            for engine in self.engines:
+                self.sample(engine)
+            stopped.wait(self.interval)
+
+    def sample(self, engine):
+        stat = self.stats[engine]
+        start = time.time()
+        lag_known = True
+        try:
+            with gevent.Timeout(self.interval):
+                with engine.connect() as conn:
+                    try:
+                        status = conn.execute('SHOW SLAVE STATUS').first()
+                    except DBAPIError as e:
+                        if e.connection_invalidated or \
+                                not _is_lag_unavailable(e):
+                            raise
+                        self._warn_lag_unavailable(engine, e)
+                        status, lag_known = None, False
+        # pylint: disable=E0712
+        except (Exception, gevent.Timeout) as e:
+            # pylint: enable=E0712
+            if engine not in self._down:
+                self._down.add(engine)
+                logger.warning("Replica %r is down, not read from until it "
+                               "recovers: %r", engine.url, e)
+            stat.healthy = False
+            return stat
+        if engine in self._down:
+            self._down.discard(engine)
+            logger.warning("Replica %r recovered", engine.url)
+        latency = time.time() - start
+        if stat.latency is None:
+            stat.latency = latency
+        else:
+            stat.latency += self.LATENCY_DECAY * (latency - stat.latency)
+        if lag_known:
+            # not a replica (e.g. master used as slave) if no slave status
+            stat.lag = status['Seconds_Behind_Master'] if status else 0
+            # `Seconds_Behind_Master` is NULL when replication is broken
+            stat.healthy = stat.lag is not None and stat.lag <= self.max_lag
+        else:
+            # reachable, lag unknown
+            stat.lag = None
+            stat.healthy = True
+        stat.sampled_at = time.time()
+        return stat
+
+    def _warn_lag_unavailable(self, engine, error):
+        if engine in self._lag_unavailable:
+            return
+        self._lag_unavailable.add(engine)
+        logger.warning("Lag of replica %r is unknown, reads are routed by "
+                       "latency only, reported once: %s", engine.url, error)
+
+    def choose(self, engines, max_lag=None):
+        """Choose a healthy engine, weighted by latency, `None` if none of
+        them are healthy (or lagging no more than `max_lag`)."""
+        if self._running:
+            self._ensure_worker()
+        candidates = []
+        for engine in engines:
+            stat = self.stats.get(engine)
+            if stat is None:
+                candidates.append((engine, None))
+                continue
+            if not stat.healthy:
+                continue
+            if max_lag is not None and (stat.sampled_at is None or
+                                        stat.lag is None or
+                                        stat.lag > max_lag):
+                continue
+            candidates.append((engine, stat.latency))
+        if not candidates:
+            return None
+        weights = [1.0 / max(latency or 0.001, 0.001)
+                   for _, latency in candidates]
+        point = random.uniform(0, sum(weights))
+        for (engine, _), weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return engine
+        return candidates[-1][0]
+
+
+class ReadYourWrites(object):
+    """Read-your-writes consistency of :class:`RoutingSession`: reads are
+    routed to master after the session has written.
+
+    :param window: seconds to read from master after the last write, `0`
+     to read from master until the scoped session is removed at the end of
+     the request/task, see :meth:`DBManager.close_sessions`
+    :param gtid: if set, leave master as soon as a replica has executed the
+     GTIDs of master at the last commit (MySQL 5.6+ with GTID enabled)
+    """
+
+    GTID_QUERY = text('SELECT @@global.gtid_executed')
+    GTID_CAUGHT_UP_QUERY = text(
+        'SELECT GTID_SUBSET(:gtid, @@global.gtid_executed)')
+
+    def __init__(self, window=0, gtid=False):
+        self.window = window
+        self.gtid = gtid
+
+
+class RoutingQuery(Query):
+    """Query of :class:`RoutingSession` with per query bind overrides, e.g.::
+
+        session.query(Foo).using_bind('master').get(1)
+    """
+
+    _bind_overrides = None
+
+    def _with_bind_overrides(self, **overrides):
+        query = self._clone()
+        query._bind_overrides = dict(self._bind_overrides or {}, **overrides)
+        return query
+
+    def using_bind(self, name):
+        """Execute this query only with the engine of `name`"""
+        return self._with_bind_overrides(name=name)
+
+    def using_max_lag(self, seconds):
+        """Execute this query only on replicas lagging no more than
+        `seconds`, see :meth:`RoutingSession.using_max_lag`"""
+        return self._with_bind_overrides(max_lag=seconds)
+
+    def get(self, ident):
+        """Get by primary key with the query baked if `DB_BAKED_QUERIES`,
+        so the select is built and compiled once per model"""
+        if settings.DB_BAKED_QUERIES and self._bakeable():
+            return self._baked_get(ident)
+        return super(RoutingQuery, self).get(ident)
+
+    def _bakeable(self):
+        # only plain `session.query(Model)`, loaded the same way as baked,
+        # criteria and the like are rejected by `Query.get`
+        if len(self._entities) != 1 or \
+                not isinstance(self._entities[0], _MapperEntity) or \
+                self._entities[0].is_aliased_class:
+            return False
+        if self._criterion is not None or self._order_by or \
+                self._group_by or self._having is not None or \
+                self._limit is not None or self._offset is not None or \
+                self._from_obj or self._statement is not None or \
+                self._distinct:
+            return False
+        return not (self._with_options or self._populate_existing or
+                    self._for_update_arg is not None or
+                    self._execution_options or self._params or
+                    self._polymorphic_adapters or
+                    self._refresh_state is not None)
+
+    def _baked_get(self, ident):
+        mapper = self._mapper_zero()
+        result = _bakery(lambda session: session.query(mapper),
+                         mapper)(self.session)
+        with self._bind_scope():
+            return result.get(ident)
+
+    def update(self, *args, **kwargs):
+        # executed by `session.execute`, not `_connection_from_session`
+        with self._bind_scope():
+            return super(RoutingQuery, self).update(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with self._bind_scope():
+            return super(RoutingQuery, self).delete(*args, **kwargs)
+
+    def _bind_scope(self):
+        # overrides are applied by `RoutingSession.get_bind`
+        return self.session.bind_scope(**(self._bind_overrides or {}))
+
+    def _connection_from_session(self, **kw):
+        with self._bind_scope():
+            return super(RoutingQuery, self)._connection_from_session(**kw)
+
+
 class RoutingSession(Session):
     _name = None
+    _max_lag = None
+    _written_at = None
+    _write_gtid = None
+    _gtid_stale = False
     CLOSE_ON_EXIT = True
 
-    def __init__(self, engines, *args, **kwds):
+    def __init__(self, engines, replica_tracker=None, read_your_writes=None,
+                 *args, **kwds):
         super(RoutingSession, self).__init__(*args, **kwds)
         self.engines = engines
         self.slave_engines = [e for role, e in engines.items()
                               if role != 'master']
         assert self.slave_engines, ValueError("DB slave configs is wrong!")
+        self.replica_tracker = replica_tracker
+        self.read_your_writes = read_your_writes
         self._close_on_exit = self.CLOSE_ON_EXIT
 
     def __enter__(self):
@@ -187,7 +760,7 @@ class RoutingSession(Session):
         return self
 
     def explain(self, query, analyze=False):
-        """EXPLAIN for mysql
+        """EXPLAIN for mysql, print and return the plan
         :param query: `Query` Object
         :param analyze: if add `EXTENDED` before query statement
         """
@@ -195,42 +768,235 @@ class RoutingSession(Session):
         for item in plan:
             for k, v in item.items():
                 print '%s: %s' % (k, v)
+        return plan
 
     def get_bind(self, mapper=None, clause=None):
+        writing = self._flushing or isinstance(clause, UpdateBase)
+        if writing:
+            self._mark_written()
         if self._name:
             return self.engines[self._name]
-        elif self._flushing:
+        elif writing:
             return self.engines['master']
+        elif self._written_at is not None:
+            return self._choose_after_write()
         else:
+            return self._choose_slave()
+
+    def _mark_written(self):
+        if self.read_your_writes is not None:
+            self._written_at = time.time()
+            self._gtid_stale = True
+
+    def _clear_written(self):
+        self._written_at = self._write_gtid = None
+        self._gtid_stale = False
+
+    def _choose_after_write(self):
+        window = self.read_your_writes.window
+        if window and time.time() - self._written_at > window:
+            self._clear_written()
+            return self._choose_slave()
+        if self._write_gtid is not None:
+            engine = self._choose_slave()
+            if engine is not self.engines['master'] and \
+                    self._caught_up(engine):
+                self._clear_written()
+                return engine
+        return self.engines['master']
+
+    def _caught_up(self, engine):
+        try:
+            return bool(engine.scalar(ReadYourWrites.GTID_CAUGHT_UP_QUERY,
+                                      gtid=self._write_gtid))
+        except SQLAlchemyError:
+            logger.exception("Error checking GTID of replica %r", engine.url)
+            return False
+
+    def commit(self):
+        super(RoutingSession, self).commit()
+        if self._gtid_stale and self.read_your_writes.gtid:
+            try:
+                self._write_gtid = self.engines['master'].scalar(
+                    ReadYourWrites.GTID_QUERY)
+            except SQLAlchemyError:
+                logger.exception("Error getting GTID of master")
+                self._write_gtid = None
+        self._gtid_stale = False
+
+    def _choose_slave(self):
+        if self.replica_tracker is None:
+            if self._max_lag is not None:
+                return self.engines['master']
             return random.choice(self.slave_engines)
+        engine = self.replica_tracker.choose(self.slave_engines,
+                                             self._max_lag)
+        if engine is None:
+            # no replica is fresh enough, read from master
+            return self.engines['master']
+        return engine
 
     def using_bind(self, name):
+        """Use the engine of `name` until the session is closed, prefer
+        :meth:`bind_scope` or :meth:`RoutingQuery.using_bind`."""
         self._name = name
         return self
 
-    def rollback(self):
-        with gevent.Timeout(5):
-            super(RoutingSession, self).rollback()
+    def using_max_lag(self, seconds):
+        """Read from replicas lagging no more than `seconds`, or from master
+        if there are none, until the session is closed."""
+        self._max_lag = seconds
+        return self
 
-    def close(self):
-        current_transactions = tuple()
-        if self.transaction is not None:
-            current_transactions = self.transaction._iterate_parents()
+    @contextlib.contextmanager
+    def bind_scope(self, name=None, max_lag=None):
+        """Override bind only within the block, e.g.::
+
+            with session.bind_scope('master'):
+                session.query(Foo).get(1)
+
+        :param name: engine name, see :meth:`using_bind`
+        :param max_lag: see :meth:`using_max_lag`
+        """
+        origin = self._name, self._max_lag
+        if name is not None:
+            self._name = name
+        if max_lag is not None:
+            self._max_lag = max_lag
         try:
-            with gevent.Timeout(5):
-                super(RoutingSession, self).close()
+            yield self
+        finally:
+            self._name, self._max_lag = origin
+
+    def stream(self, query, chunk_size=None):
+        """Yield results of `query` in lists of `chunk_size` (default
+        `DB_STREAM_CHUNK_SIZE`), fetched by a server-side cursor on mysql, so
+        huge results are iterated in constant memory, e.g.::
+
+            for foos in session.stream(session.query(Foo)):
+                export(foos)
+
+        Queries are read from replicas as usual. NOTE: the connection is
+        busy until the results are exhausted, don't read from the same
+        engine by this session meanwhile, prefer :meth:`iter_keyset` if
+        the loop body queries.
+        """
+        chunk_size = chunk_size or settings.DB_STREAM_CHUNK_SIZE
+        results = iter(query.with_session(self).yield_per(chunk_size))
+        while 1:
+            chunk = list(itertools.islice(results, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def iter_keyset(self, query, chunk_size=None, key=None):
+        """Yield results of `query` in lists of `chunk_size` (default
+        `DB_STREAM_CHUNK_SIZE`) by keyset pagination, every chunk is a
+        short query of ``key > last ORDER BY key LIMIT chunk_size``.
+
+        :param key: unique attribute ordered by, selected by `query`,
+         default the primary key of the first entity
+        """
+        chunk_size = chunk_size or settings.DB_STREAM_CHUNK_SIZE
+        if key is None:
+            mapper = query._mapper_zero()
+            assert len(mapper.primary_key) == 1, \
+                "Pass `key` for entities of composite primary keys"
+            key = mapper.get_property_by_column(
+                mapper.primary_key[0]).class_attribute
+        query = query.with_session(self).order_by(None).order_by(key)
+        last = None
+        while 1:
+            chunk_query = query
+            if last is not None:
+                chunk_query = chunk_query.filter(key > last)
+            chunk = chunk_query.limit(chunk_size).all()
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = getattr(chunk[-1], key.key)
+
+    def _root_transaction(self):
+        transaction = self.transaction
+        while transaction is not None and transaction._parent is not None:
+            transaction = transaction._parent
+        return transaction
+
+    @staticmethod
+    def _cleanup_timeout(transaction):
+        """Max rollback/close timeout of the engines in `transaction`, by
+        ``close_timeout`` of `DB_SETTINGS` or `DB_CLOSE_TIMEOUT`"""
+        conns = ()
+        if transaction is not None and transaction._connections:
+            conns = set(item[0] for item in transaction._connections.values())
+        return max([_engine_option(conn.engine, 'close_timeout',
+                                   settings.DB_CLOSE_TIMEOUT)
+                    for conn in conns] or [settings.DB_CLOSE_TIMEOUT])
+
+    @contextlib.contextmanager
+    def _cleanup_scope(self, action):
+        # the session may have moved to a new transaction when timed out
+        transaction = self._root_transaction()
+        timeout = gevent.Timeout(self._cleanup_timeout(transaction))
+        timeout.start()
+        try:
+            yield
         # pylint: disable=E0712
-        except gevent.Timeout:
+        except gevent.Timeout as e:
             # pylint: enable=E0712
-            close_connections(self.engines.itervalues(), current_transactions)
-            raise
+            if e is not timeout:
+                raise
+            logger.warning("Timeout %s session %r, quarantine connections",
+                           action, self.info.get('name'))
+            self._quarantine(transaction)
+        finally:
+            timeout.cancel()
+
+    def _quarantine(self, transaction):
+        self.transaction = None
+        self.expunge_all()
+        if transaction is not None:
+            connection_quarantine.put(transaction)
+        if not self.autocommit:
+            self.begin()
+
+    def rollback(self):
+        with self._cleanup_scope('rolling back'):
+            super(RoutingSession, self).rollback()
+
+    def close(self):
+        # writes are kept, sessions are closed by every `with session()`
+        # block, and thrown away with them when scoped sessions are removed
+        self._name = self._max_lag = None
+        with self._cleanup_scope('closing'):
+            super(RoutingSession, self).close()
+
+
+def _mysql_create_cursor(self):
+    # backported from sqlalchemy 1.1, fetch results by server-side cursors
+    # if `stream_results`, e.g. by `Query.yield_per`
+    if self.execution_options.get('stream_results') and \
+            self.compiled is not None and \
+            isinstance(self.compiled.statement, Selectable):
+        return self._dbapi_connection.cursor(
+            self.dialect.dbapi.cursors.SSCursor)
+    # engines of `walila.prepared`
+    size = self.execution_options.get('prepared_statements')
+    if size and self.compiled is not None and \
+            isinstance(self.compiled.statement, Selectable):
+        from .prepared import prepared_cursor
+        return prepared_cursor(self._dbapi_connection, size)
+    return self._dbapi_connection.cursor()
+
+
+MySQLExecutionContext.create_cursor = _mysql_create_cursor
 
 
 def patch_engine(engine):
-    pool = engine.pool
-    pool._origin_recyle = pool._recycle
-    del pool._recycle
-    setattr(pool.__class__, '_recycle', RecycleField())
+    """Deprecated, connections are recycled by :class:`walila.pool.PoolReaper`
+    started by :class:`DBManager`"""
     return engine
 
 
@@ -239,19 +1005,189 @@ def create_engine(*args, **kwds):
     return engine
 
 
-def make_session(engines, force_scope=False, info=None):
-    session = scoped_session(
+def greenlet_scope():
+    """Current greenlet if gevent has patched threads, else current thread.
+
+    Decided on every call, since gevent may patch after sessions created
+    (e.g. gunicorn gevent worker patches after ``post_fork``).
+    """
+    if monkey.is_module_patched('thread'):
+        return gevent.getcurrent()
+    return threading.current_thread()
+
+
+class WeakScopedRegistry(ScopedRegistry):
+    """Forget sessions of dead greenlets/threads not removed explicitly"""
+
+    def __init__(self, createfunc, scopefunc):
+        super(WeakScopedRegistry, self).__init__(createfunc, scopefunc)
+        self.registry = weakref.WeakKeyDictionary()
+
+
+class GreenletScopedSession(scoped_session):
+    """`scoped_session` scoped by :func:`greenlet_scope`, sessions should
+    be removed at the end of requests/tasks, see
+    :meth:`DBManager.close_sessions`."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.registry = WeakScopedRegistry(session_factory, greenlet_scope)
+
+
+def make_session(engines, force_scope=False, info=None,
+                 replica_tracker=None, read_your_writes=None, scope=None):
+    """
+    :param scope: ``thread`` for thread-local sessions, ``greenlet`` for
+     :class:`GreenletScopedSession`, default `DB_SESSION_SCOPE`
+    """
+    scope = scope or settings.DB_SESSION_SCOPE
+    if scope == 'greenlet':
+        scoped_session_cls = GreenletScopedSession
+    else:
+        scoped_session_cls = scoped_session
+    session = scoped_session_cls(
         sessionmaker(
             class_=RoutingSession,
+            query_cls=RoutingQuery,
             expire_on_commit=False,
             engines=engines,
+            replica_tracker=replica_tracker,
+            read_your_writes=read_your_writes,
             info=info or {"name": uuid.uuid4().hex},
         ),
-        scopefunc=None
     )
     return session
 
 
+class GatherTimeout(Exception):
+    pass
+
+
+def _call_in_session(scoped, func, timeout=None):
+    # a new session, not the one of the scope shared by greenlets if
+    # sessions are thread scoped
+    session = scoped.session_factory()
+    try:
+        with gevent.Timeout(timeout, GatherTimeout(
+                "Not done in %ss" % timeout)):
+            return func(session)
+    finally:
+        session.close()
+
+
+def _gather(calls, timeout=None):
+    """Call `calls` of ``{key: (scoped_session, func[, timeout])}`` in
+    parallel greenlets, each ``func(session)`` with a new session of its
+    scoped session closed after, and return ``{key: result}``.
+
+    The first error is raised and other calls are killed, so is
+    :class:`GatherTimeout` if a call is not done in its `timeout` seconds,
+    default `timeout`. Queries only run concurrently if gevent has patched
+    sockets.
+    """
+    jobs = {}
+    for key, call in calls.iteritems():
+        scoped, func = call[:2]
+        jobs[key] = gevent.spawn(_call_in_session, scoped, func,
+                                 call[2] if len(call) > 2 else timeout)
+    try:
+        gevent.joinall(jobs.values(), raise_error=True)
+    finally:
+        gevent.killall([job for job in jobs.itervalues() if not job.ready()],
+                       block=False)
+    return {key: job.value for key, job in jobs.iteritems()}
+
+
+def hash_shard(key, shards):
+    """Shard of `key` by crc32 of it, stable across processes unlike
+    `hash`"""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return shards[(zlib.crc32(str(key)) & 0xffffffff) % len(shards)]
+
+
+class RangeShard(object):
+    """Shard keys by ranges split by `bounds`, e.g. bounds
+    ``[1000000, 2000000]`` of 3 shards routes keys below 1000000 to the
+    first shard, keys from 2000000 to the last one"""
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+
+    def __call__(self, key, shards):
+        return shards[bisect.bisect_right(self.bounds, key)]
+
+
+class ShardedRoutingSession(object):
+    """Route to sessions of shards by shard key, each shard is a database
+    of `DB_SETTINGS` with own master and slaves, configured by `DB_SHARDS`:
+
+        DB_SHARDS = {
+            'orders': {
+                'shards': ['orders_0', 'orders_1'],
+                # `hash`, `range` with `ranges`, or path of a
+                # `func(key, shards)` returning the shard of `key`
+                'shard_key': 'hash',
+            },
+        }
+
+    e.g.
+
+        orders = db_manager.get_sharded_session('orders')
+
+        with orders(user_id) as session:
+            session.add(Order(user_id=user_id))
+
+        orders.gather(lambda session: session.query(Order).filter(
+            Order.created_at > since).all(),
+            key=lambda order: order.created_at)
+
+    """
+
+    def __init__(self, name, sessions, shard_key=hash_shard):
+        """
+        :param sessions: ordered ``[(shard, scoped_session), ...]``
+        """
+        self.name = name
+        self.shards = [shard for shard, _ in sessions]
+        self.sessions = dict(sessions)
+        self.shard_key = shard_key
+
+    def shard_for(self, key):
+        return self.shard_key(key, self.shards)
+
+    def get_session(self, key):
+        """Scoped session of the shard of `key`"""
+        return self.sessions[self.shard_for(key)]
+
+    def __call__(self, key):
+        return self.get_session(key)()
+
+    def scatter(self, func, shards=None, timeout=None):
+        """Call ``func(session)`` on `shards` (default all) in parallel
+        greenlets, see :func:`_gather`.
+
+        :return: ``{shard: result}``
+        """
+        return _gather({shard: (self.sessions[shard], func)
+                        for shard in shards or self.shards}, timeout)
+
+    def gather(self, func, shards=None, timeout=None, key=None,
+               reverse=False, limit=None):
+        """:meth:`scatter` `func` returning lists of rows and merge them,
+        sorted by `key` if given.
+
+        NOTE: each shard should apply `limit` and the order in `func`
+        """
+        shards = shards or self.shards
+        results = self.scatter(func, shards, timeout)
+        rows = list(itertools.chain.from_iterable(
+            results[shard] for shard in shards))
+        if key is not None:
+            rows.sort(key=key, reverse=reverse)
+        return rows if limit is None else rows[:limit]
+
+
 def gen_commit_deco(session_factory, raise_exc, error_code):
     def decorated(func):
         @functools.wraps(func)
@@ -269,7 +1205,6 @@ class ModelMeta(DeclarativeMeta):
     def __new__(self, name, bases, attrs):
         cls = DeclarativeMeta.__new__(self, name, bases, attrs)
 
-        # TODO: :class: `CacheMixinBase
         from .cache import CacheMixinBase
         for base in bases:
             if issubclass(base, CacheMixinBase) and hasattr(cls, "_hook"):
@@ -288,17 +1223,12 @@ def model_base(cls=object):
     return declarative_base(cls=cls, metaclass=ModelMeta)
 
 
-class RecycleField(object):
-    def __get__(self, instance, klass):
-        if instance is not None:
-            return int(random.uniform(0.75, 1) * instance._origin_recyle)
-        raise AttributeError
-
-
 class DBManager(object):
     def __init__(self):
         self.loaded = False  # only create session once
         self.session_map = {}
+        self.shard_map = {}
+        self.pool_reapers = {}
 
     def create_sessions(self):
         if not self.loaded:
@@ -306,6 +1236,8 @@ class DBManager(object):
                 raise ValueError('DB_SETTINGS is empty, check it')
             for db, db_configs in settings.DB_SETTINGS.iteritems():
                 self.add_session(db, db_configs)
+            for name, config in settings.DB_SHARDS.iteritems():
+                self.add_sharded_session(name, config)
             self.loaded = True
 
     def get_session(self, name):
@@ -315,12 +1247,76 @@ class DBManager(object):
             raise KeyError(
                 '`%s` session not created, check `DB_SETTINGS`' % name)
 
+    def gather(self, calls, timeout=None):
+        """Run independent queries on sessions of `DB_SETTINGS` concurrently
+        in greenlets, so they take as long as the slowest one instead of
+        all of them, see :func:`_gather`.
+
+        e.g.
+
+            results = db_manager.gather({
+                'user': ('user', lambda session: session.query(User).get(1)),
+                'orders': ('order', lambda session: session.query(Order)
+                           .using_bind('slave').all(), 0.5),
+            }, timeout=1)
+
+        :param calls: ``{key: (name, func[, timeout])}``, ``func(session)``
+         is called with a new session of `name`, closed after, commit in
+         `func` to write
+        :param timeout: seconds of calls without own timeouts, default
+         `DB_GATHER_TIMEOUT`
+        :return: ``{key: result}``
+        """
+        if timeout is None:
+            timeout = settings.DB_GATHER_TIMEOUT or None
+        return _gather({key: (self.get_session(call[0]),) + tuple(call[1:])
+                        for key, call in calls.iteritems()}, timeout)
+
+    def get_sharded_session(self, name):
+        try:
+            return self.shard_map[name]
+        except KeyError:
+            raise KeyError(
+                '`%s` sharded session not created, check `DB_SHARDS`' % name)
+
+    def add_sharded_session(self, name, config):
+        if name in self.shard_map:
+            raise ValueError("Duplicate sharded session name {},"
+                             "please check your config".format(name))
+        shards = config['shards']
+        if not shards:
+            raise ValueError("No shards of {}".format(name))
+        # shard sessions are removed by `close_sessions` with others
+        session = ShardedRoutingSession(
+            name, [(shard, self.get_session(shard)) for shard in shards],
+            self._make_shard_key(name, config))
+        self.shard_map[name] = session
+        return session
+
+    @classmethod
+    def _make_shard_key(cls, name, config):
+        shard_key = config.get('shard_key', 'hash')
+        if shard_key == 'hash':
+            return hash_shard
+        if shard_key == 'range':
+            ranges = config['ranges']
+            if len(ranges) != len(config['shards']) - 1:
+                raise ValueError("{} ranges should split {} shards".format(
+                    name, len(config['shards'])))
+            return RangeShard(ranges)
+        if callable(shard_key):
+            return shard_key
+        from celery.utils.imports import symbol_by_name
+        return symbol_by_name(shard_key)
+
     def add_session(self, name, config):
         if name in self.session_map:
             raise ValueError("Duplicate session name {},"
                              "please check your config".format(name))
         session = self._make_session(name, config)
         self.session_map[name] = session
+        self.pool_reapers[name] = self._start_pool_reapers(
+            name, session.session_factory.kw['engines'], config)
         return session
 
     @classmethod
@@ -328,19 +1324,110 @@ class DBManager(object):
         urls = config['urls']
         for name, url in urls.iteritems():
             assert url, "Url configured not properly for %s:%s" % (db, name)
-        pool_size = config.get('pool_size', settings.DB_POOL_SIZE)
-        max_overflow = config.get(
-            'max_overflow', settings.DB_MAX_OVERFLOW)
-        pool_recycle = settings.DB_POOL_RECYCLE
-        engines = {
-            role: cls.create_engine(dsn,
-                                    pool_size=pool_size,
-                                    max_overflow=max_overflow,
-                                    pool_recycle=pool_recycle,
-                                    execution_options={'role': role})
-            for role, dsn in urls.iteritems()
+        prepared_statements = config.get('prepared_statements',
+                                         settings.DB_PREPARED_STATEMENTS)
+        engines = {}
+        for role, dsn in urls.iteritems():
+            options = cls._pool_options(db, role, config)
+            if prepared_statements:
+                # prepared cursors are of the pure python connection
+                options['connect_args'] = {'use_pure': True}
+            engines[role] = cls.create_engine(
+                dsn,
+                execution_options={
+                    'role': role,
+                    'db': db,
+                    'close_timeout': cls._close_timeout(role, config),
+                },
+                **options)
+        if prepared_statements:
+            from . import prepared
+            for engine in engines.itervalues():
+                prepared.install(engine, prepared_statements)
+        if settings.DB_PROFILE:
+            from .profiler import query_profiler
+            for engine in engines.itervalues():
+                query_profiler.install(engine)
+        return make_session(engines, info={"name": db},
+                            replica_tracker=cls._make_replica_tracker(
+                                engines, config),
+                            read_your_writes=cls._make_read_your_writes(
+                                config))
+
+    @classmethod
+    def _close_timeout(cls, role, config):
+        timeout = config.get('close_timeout', settings.DB_CLOSE_TIMEOUT)
+        if isinstance(timeout, dict):
+            # by roles, e.g. `{'master': 10, 'slave': 3}`
+            timeout = timeout.get(role, settings.DB_CLOSE_TIMEOUT)
+        return timeout
+
+    @classmethod
+    def _pool_options(cls, db, role, config):
+        options = {
+            'pool_size': config.get('pool_size', settings.DB_POOL_SIZE),
+            'max_overflow': config.get(
+                'max_overflow', settings.DB_MAX_OVERFLOW),
+            'pool_recycle': settings.DB_POOL_RECYCLE,
+            'pool_timeout': config.get(
+                'pool_timeout', settings.DB_POOL_TIMEOUT),
         }
-        return make_session(engines, info={"name": db})
+        if config.get('pool_class', settings.DB_POOL_CLASS) == 'green':
+            from .pool import GreenQueuePool
+            options.update(
+                poolclass=GreenQueuePool,
+                pre_ping_interval=config.get(
+                    'pool_pre_ping_interval',
+                    settings.DB_POOL_PRE_PING_INTERVAL),
+                metric_prefix='db.%s.%s.pool' % (db, role))
+        return options
+
+    @classmethod
+    def _start_pool_reapers(cls, db, engines, config):
+        interval = config.get('pool_reap_interval',
+                              settings.DB_POOL_REAP_INTERVAL)
+        if not interval:
+            return []
+        from .pool import PoolReaper
+        reapers = []
+        for role, engine in engines.iteritems():
+            min_idle = config.get('pool_min_idle', settings.DB_POOL_MIN_IDLE)
+            if isinstance(min_idle, dict):
+                min_idle = min_idle.get(role, 0)
+            reapers.append(PoolReaper(
+                engine, interval, min_idle,
+                metric_prefix='db.%s.%s.pool' % (db, role)).start())
+        return reapers
+
+    @classmethod
+    def _make_read_your_writes(cls, config):
+        if not config.get('read_your_writes',
+                          settings.DB_READ_YOUR_WRITES):
+            return None
+        return ReadYourWrites(
+            window=config.get('read_your_writes_window',
+                              settings.DB_READ_YOUR_WRITES_WINDOW),
+            gtid=config.get('read_your_writes_gtid',
+                            settings.DB_READ_YOUR_WRITES_GTID))
+
+    @classmethod
+    def _make_replica_tracker(cls, engines, config):
+        interval = config.get('replica_check_interval',
+                              settings.DB_REPLICA_CHECK_INTERVAL)
+        if not interval:
+            return None
+        max_lag = config.get('replica_max_lag', settings.DB_REPLICA_MAX_LAG)
+        slave_engines = [e for role, e in engines.iteritems()
+                         if role != 'master']
+        return ReplicaTracker(slave_engines, interval, max_lag).start()
+
+    def reset_pools(self):
+        """Replace pools of all engines with empty ones, in processes forked
+        after connections opened. Connections of the old pools are left
+        open, they belong to the parent process."""
+        for dbsession in self.session_map.itervalues():
+            for engine in dbsession.session_factory.kw['engines'].itervalues():
+                engine.pool = engine.pool.recreate()
 
     def close_sessions(self, should_close_connection=False):
         dbsessions = self.session_map
@@ -355,6 +1442,65 @@ class DBManager(object):
             except:
                 logger.exception("Error closing session")
 
+    def warm_up(self, connections=None, queries=None, timeout=None):
+        """Open connections of all engines in parallel greenlets and run
+        warm-up queries on them, then return them to pools.
+
+        :param connections: connections per engine, default
+         `DB_WARM_UP_CONNECTIONS`, or ``warm_up_connections`` of
+         `DB_SETTINGS` which can also be a dict of ``{role: connections}``
+        :param queries: default `DB_WARM_UP_QUERIES`
+        :param timeout: default `DB_WARM_UP_TIMEOUT`
+        :return: number of connections opened
+        """
+        if queries is None:
+            queries = settings.DB_WARM_UP_QUERIES
+        timeout = timeout or settings.DB_WARM_UP_TIMEOUT
+        jobs = []
+        for name, dbsession in self.session_map.iteritems():
+            config = settings.DB_SETTINGS.get(name, {})
+            for role, engine in dbsession.session_factory.kw[
+                    'engines'].iteritems():
+                n = connections
+                if n is None:
+                    n = config.get('warm_up_connections',
+                                   settings.DB_WARM_UP_CONNECTIONS)
+                if isinstance(n, dict):
+                    n = n.get(role, 0)
+                # connections beyond pool size are closed when returned
+                n = min(n, engine.pool.size() or n)
+                jobs.extend(gevent.spawn(self._warm_up_connection,
+                                         engine, queries)
+                            for _ in range(n))
+        if not jobs:
+            return 0
+        gevent.joinall(jobs, timeout=timeout)
+        gevent.killall([job for job in jobs if not job.ready()],
+                       block=False)
+        conns = [job.value for job in jobs if job.successful()]
+        for conn in conns:
+            conn.close()
+        failed = len(jobs) - len(conns)
+        if failed:
+            logger.warning("%d connections failed to warm up", failed)
+        return len(conns)
+
+    @staticmethod
+    def _warm_up_connection(engine, queries):
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                for query in queries:
+                    cursor.execute(query)
+            finally:
+                cursor.close()
+        except Exception:
+            logger.exception("Error warming up %r", engine.url)
+            conn.close()
+            raise
+        return conn
+
     @classmethod
     def create_engine(cls, *args, **kwds):
         engine = patch_engine(sqlalchemy_create_engine(*args, **kwds))
@@ -33,13 +33,17 @@ initialized = False
 settings_updated = False
 loggers_initialized = False
 sessions_created = False
+db_warmed_up = False
 
 
-def initialize():
+def initialize(warm_up=True):
     """Initialize worker process envrionment, include:
     logging, settings, db sessions etc. It should be called before all other
     operations are taken, right after a worker is forked (``post_fork``) or
     in cmd entry points. Please note the other of these operations.
+
+    :param warm_up: warm up db connections, set `False` to call
+     :func:`warm_up_db` later, e.g. after gevent patched
     """
     global initialized
     if initialized:
@@ -47,6 +51,8 @@ def initialize():
     init_loggers()
     update_settings()
     create_db_sessions()
+    if warm_up:
+        warm_up_db()
     initialized = True
 
 
@@ -77,9 +83,24 @@ def create_db_sessions():
     global sessions_created
     if sessions_created:
         return logger.warning("db sessions are already created, skipping")
-    from .db import db_manager, patch_column_type_checker
+    from .db import db_manager
     from .settings import settings
-    patch_column_type_checker()
+    from .typecheck import type_checker
+    type_checker.install()
     if not EmptyValue.is_empty(settings.DB_SETTINGS):
         db_manager.create_sessions()
     sessions_created = True
+
+
+def warm_up_db():
+    """Open db connections ahead of traffic if `DB_WARM_UP_CONNECTIONS`
+    configured, (rely ``create_db_sessions``)"""
+    global db_warmed_up
+    if db_warmed_up:
+        return logger.warning("db connections are already warmed up, skipping")
+    from .db import db_manager
+    if db_manager.loaded:
+        opened = db_manager.warm_up()
+        if opened:
+            logger.info("Warmed up %d db connections", opened)
+    db_warmed_up = True
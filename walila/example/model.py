@@ -8,6 +8,7 @@ from sqlalchemy import (
 )
 
 from walila.settings import settings
+from walila.cache import CacheMixin
 from walila.db import db_manager, model_base
 
 
@@ -24,6 +25,8 @@ class DBSetting(object):
         }
     }
 
+    CACHE_REDIS_URL = "redis://localhost:6379/0"
+
 settings.from_object(DBSetting)
 
 ModelBase = model_base()
@@ -31,9 +34,12 @@ db_manager.create_sessions()
 DBSession = db_manager.get_session('walila')
 
 
-class TODOList(ModelBase):
+class TODOList(ModelBase, CacheMixin):
 
     __tablename__ = 'todo'
+    __db__ = 'walila'
+    __cache_local_size__ = 1000
+    __cache_negative_ttl__ = 60
 
     id = Column(Integer, primary_key=True)
     title = Column(String, default='')
@@ -48,8 +54,7 @@ class TODOList(ModelBase):
 
     @classmethod
     def get(cls, todo_id):
-        session = DBSession()
-        todo = session.query(cls).get(todo_id)
+        todo = super(TODOList, cls).get(todo_id)
         if todo:
             return todo.to_dict()
 
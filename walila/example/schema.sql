@@ -6,3 +6,23 @@ CREATE TABLE IF NOT EXISTS todo (
     is_done INT(1) DEFAULT 0,
     KEY `idx_key` (`id`, `title`)
 );
+
+-- tables created without `fingerprint` are migrated by, in order, adding the
+-- column, FailedTask.backfill_fingerprints() and
+-- FailedTask.add_fingerprint_key(), see walila/model.py
+CREATE TABLE IF NOT EXISTS FailedTask (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    fingerprint CHAR(40) NOT NULL,
+    name VARCHAR(125) NOT NULL,
+    full_name TEXT NOT NULL,
+    args TEXT,
+    kwargs TEXT,
+    exception_class TEXT NOT NULL,
+    exception_msg TEXT NOT NULL,
+    traceback TEXT,
+    task_id VARCHAR(36) NOT NULL,
+    failures INT NOT NULL DEFAULT 1,
+    need_retry TINYINT(1) NOT NULL DEFAULT 1,
+    UNIQUE KEY `uk_fingerprint` (`fingerprint`),
+    KEY `ix_name` (`name`)
+);
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import logging
+import collections
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """Count, sum, max and histogram of timings in seconds"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # the last one counts timings greater than all buckets
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            index = len(self.BUCKETS)
+        self.buckets[index] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'avg': self.total / self.count if self.count else 0,
+            'buckets': zip(self.BUCKETS + ('inf',), self.buckets),
+        }
+
+
+class Metrics(object):
+    """In process counters, gauges and timers, also sent to statsd if
+    `STATSD_SETTINGS` (``host:port``) is configured.
+
+    e.g.
+
+        from walila.metrics import metrics
+
+        metrics.incr('db.pool.overflow')
+        metrics.timing('db.pool.wait', 0.02)
+        metrics.snapshot()
+
+    """
+
+    def __init__(self, prefix='walila'):
+        self.prefix = prefix
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.timers = collections.defaultdict(Timer)
+        self._statsd_addr = None
+        self._statsd_sock = None
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+        self._send(name, value, 'c')
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        self._send(name, value, 'g')
+
+    def timing(self, name, seconds):
+        self.timers[name].add(seconds)
+        self._send(name, int(seconds * 1000), 'ms')
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'timers': {name: timer.to_dict()
+                       for name, timer in self.timers.iteritems()},
+        }
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.timers.clear()
+
+    def _get_statsd_addr(self):
+        statsd = settings.STATSD_SETTINGS
+        if not statsd:
+            return None
+        if self._statsd_addr is None or self._statsd_addr[0] != statsd:
+            host, _, port = statsd.partition(':')
+            self._statsd_addr = (statsd, (host, int(port or 8125)))
+        return self._statsd_addr[1]
+
+    def _send(self, name, value, type_):
+        addr = self._get_statsd_addr()
+        if addr is None:
+            return
+        try:
+            if self._statsd_sock is None:
+                self._statsd_sock = socket.socket(socket.AF_INET,
+                                                  socket.SOCK_DGRAM)
+            self._statsd_sock.sendto(
+                '%s.%s:%s|%s' % (self.prefix, name, value, type_), addr)
+        except Exception:
+            logger.debug("Error sending metric %r to statsd", name,
+                         exc_info=True)
+
+
+metrics = Metrics()
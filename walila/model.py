@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import json
+import logging
+import hashlib
 import importlib
 
 from sqlalchemy import (
@@ -9,18 +11,65 @@ from sqlalchemy import (
     Integer,
     Text,
     Boolean,
+    func,
+    or_,
 )
 from sqlalchemy.ext.declarative import declarative_base
 
+from .db import db_manager, UpsertMixin
+from .settings import settings, ConfigError
+
+logger = logging.getLogger(__name__)
 
 # model base
 Model = declarative_base()
 
+_fallback_warned = set()
+
+
+def failed_task_db():
+    """Name of the db where `FailedTask` lives, `FAILED_TASK_DB`, or the only
+    db of `DB_SETTINGS` if it's not set.
+
+    :raise ConfigError: if it's not in `DB_SETTINGS`, or not set while
+     there are more dbs
+    """
+    name = settings.FAILED_TASK_DB
+    if name:
+        if name not in settings.DB_SETTINGS:
+            raise ConfigError("FAILED_TASK_DB %r not in DB_SETTINGS" % name)
+        return name
+    if len(settings.DB_SETTINGS) != 1:
+        raise ConfigError("FAILED_TASK_DB not set, with %d dbs in "
+                          "DB_SETTINGS" % len(settings.DB_SETTINGS))
+    name = settings.DB_SETTINGS.keys()[0]
+    if name not in _fallback_warned:
+        _fallback_warned.add(name)
+        logger.warning("FAILED_TASK_DB not set, failed tasks are saved to "
+                       "the only db %r", name)
+    return name
+
+
+def get_session():
+    """Session of the db where `FailedTask` lives, see :func:`failed_task_db`
+    """
+    return db_manager.get_session(failed_task_db())
 
-class FailedTask(Model):
+
+def _to_unicode(value):
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return unicode(value)
+
+
+class FailedTask(Model, UpsertMixin):
 
     __tablename__ = 'FailedTask'
 
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String(40), nullable=False, unique=True)
     name = Column(String(125), nullable=False, index=True)
     full_name = Column(Text, nullable=False)
     args = Column(Text)
@@ -32,6 +81,25 @@ class FailedTask(Model):
     failures = Column(Integer, nullable=False, default=1)
     need_retry = Column(Boolean, nullable=False, default=True)
 
+    @staticmethod
+    def make_fingerprint(full_name, args, kwargs, exception_class,
+                         exception_msg):
+        """Fixed-length digest identifying the same failure of a task"""
+        raw = u'\x00'.join(_to_unicode(v) for v in (
+            full_name, args, kwargs, exception_class, exception_msg))
+        return hashlib.sha1(raw.encode('utf8')).hexdigest()
+
+    @classmethod
+    def save_failures(cls, rows):
+        """Save failed tasks by :meth:`UpsertMixin.bulk_upsert`, in chunks
+        within `DB_MAX_ALLOWED_PACKET`, `failures` of the existing ones are
+        increased by the `failures` of rows.
+
+        :param rows: list of dict with the same keys, `fingerprint` included
+        """
+        return cls.bulk_upsert(rows, session=get_session(),
+                               increment_columns=['failures'])
+
     def retry_and_delete(self, inline=False):
         """Retry task and delete if success."""
         mod_name, func_name = self.full_name.rsplit('.', 1)
@@ -52,18 +120,161 @@ class FailedTask(Model):
 
     @classmethod
     def get_all_need_retry(cls):
-        """Get all need retry tasks"""
-        return cls.query.filter(cls.need_retry.is_(True)).all()
+        """Get all need retry tasks, use :meth:`iter_need_retry` for large
+        tables"""
+        return get_session()().query(cls).filter(
+            cls.need_retry.is_(True)).all()
 
-    def delete(self):
+    @classmethod
+    def iter_need_retry(cls, batch_size=500, names=None):
+        """Yield need retry tasks in batches by `id` order, each row has only
+        ``id``, ``name``, ``args`` and ``kwargs`` loaded.
+
+        :param names: only tasks of these names if given
         """
-        with DBSession() as session:
-            session.delete(self)
+        session = get_session()()
+        query = session.query(cls.id, cls.name, cls.args, cls.kwargs).filter(
+            cls.need_retry.is_(True))
+        if names:
+            query = query.filter(cls.name.in_(names))
+        return session.iter_keyset(query, batch_size, key=cls.id)
+
+    @classmethod
+    def finish_retry(cls, ids, delete=True):
+        """Delete retried tasks in bulk, or mark them as no need to retry.
+
+        :return: number of rows affected
         """
+        if not ids:
+            return 0
+        # a new session, not the one of the caller's scope
+        with get_session().session_factory().using_bind('master') as db:
+            query = db.query(cls).filter(cls.id.in_(ids))
+            if delete:
+                return query.delete(synchronize_session=False)
+            return query.update({cls.need_retry: False},
+                                synchronize_session=False)
+
+    def delete(self):
+        self.finish_retry([self.id])
 
     @classmethod
     def get_task(cls, full_name, args, kwargs, exception_class, exception_msg):
-        return cls.query.filter(
-            cls.full_name == full_name, cls.args == args, cls.kwargs == kwargs,
-            cls.exception_class == exception_class,
-            cls.exception_msg == exception_msg).first()
+        return cls.get_by_fingerprint(cls.make_fingerprint(
+            full_name, args, kwargs, exception_class, exception_msg))
+
+    @classmethod
+    def get_by_fingerprint(cls, fingerprint):
+        return get_session()().query(cls).filter(
+            cls.fingerprint == fingerprint).first()
+
+    @classmethod
+    def backfill_fingerprints(cls, batch_size=500):
+        """Fill `fingerprint` of rows created before the column exists, rows
+        of the same failure are merged into the first one with their
+        `failures` summed up. Migrate an existing table in this order::
+
+            ALTER TABLE FailedTask ADD COLUMN fingerprint CHAR(40) NULL,
+                ADD KEY `ix_fingerprint` (`fingerprint`);
+            -- deploy, then FailedTask.backfill_fingerprints()
+            -- FailedTask.add_fingerprint_key()
+
+        Until the UNIQUE key exists, upserts of :meth:`save_failures` insert
+        a row for every flush of a failure, which are merged by
+        :meth:`add_fingerprint_key` before adding the key.
+
+        :return: number of rows merged
+        """
+        merged = 0
+        last_id = 0
+        while last_id is not None:
+            # a new session committed and closed by every batch, not the
+            # one of the caller's scope
+            with get_session().session_factory().using_bind('master') as db:
+                last_id, batch_merged = cls._backfill_batch(
+                    db, last_id, batch_size)
+                merged += batch_merged
+        return merged
+
+    @classmethod
+    def add_fingerprint_key(cls, batch_size=500):
+        """Add the UNIQUE key of `fingerprint` after
+        :meth:`backfill_fingerprints`, with the table locked, the rows
+        inserted meanwhile backfilled and duplicates merged before it::
+
+            LOCK TABLES FailedTask WRITE;
+            -- backfill and merge
+            ALTER TABLE FailedTask MODIFY fingerprint CHAR(40) NOT NULL,
+                DROP KEY `ix_fingerprint`,
+                ADD UNIQUE KEY `uk_fingerprint` (`fingerprint`);
+            UNLOCK TABLES;
+
+        :return: number of rows merged
+        """
+        merged = 0
+        table = cls.__tablename__
+        with get_session().session_factory().using_bind('master') as db:
+            conn = db.connection()
+            conn.execute('LOCK TABLES %s WRITE' % table)
+            try:
+                last_id = 0
+                while last_id is not None:
+                    last_id, batch_merged = cls._backfill_batch(
+                        db, last_id, batch_size)
+                    merged += batch_merged
+                merged += cls._merge_duplicates(db)
+                db.flush()
+                conn.execute(
+                    'ALTER TABLE %s MODIFY fingerprint CHAR(40) NOT NULL, '
+                    'DROP KEY `ix_fingerprint`, '
+                    'ADD UNIQUE KEY `uk_fingerprint` (`fingerprint`)' % table)
+            finally:
+                conn.execute('UNLOCK TABLES')
+        return merged
+
+    @classmethod
+    def _backfill_batch(cls, db, last_id, batch_size):
+        """:return: id of the last row backfilled, None if there are no more,
+         and number of rows merged"""
+        rows = db.query(cls).filter(
+            cls.id > last_id,
+            or_(cls.fingerprint.is_(None), cls.fingerprint == ''),
+        ).order_by(cls.id).limit(batch_size).all()
+        if not rows:
+            return None, 0
+        fingerprints = {row.id: cls.make_fingerprint(
+            row.full_name, row.args, row.kwargs, row.exception_class,
+            row.exception_msg) for row in rows}
+        owners = {task.fingerprint: task for task in db.query(cls).filter(
+            cls.fingerprint.in_(set(fingerprints.values()))).order_by(
+                cls.id.desc())}
+        return rows[-1].id, cls._merge_rows(db, rows, fingerprints, owners)
+
+    @classmethod
+    def _merge_duplicates(cls, db):
+        """Merge rows of the same `fingerprint` into the first one"""
+        duplicated = [fingerprint for fingerprint, in db.query(
+            cls.fingerprint).group_by(cls.fingerprint).having(
+                func.count(cls.id) > 1)]
+        if not duplicated:
+            return 0
+        rows = db.query(cls).filter(
+            cls.fingerprint.in_(duplicated)).order_by(cls.id).all()
+        fingerprints = {row.id: row.fingerprint for row in rows}
+        return cls._merge_rows(db, rows, fingerprints, {})
+
+    @classmethod
+    def _merge_rows(cls, db, rows, fingerprints, owners):
+        # rows without an owner of their fingerprint become the owner
+        merged = 0
+        for row in rows:
+            fingerprint = fingerprints[row.id]
+            owner = owners.get(fingerprint)
+            if owner is None:
+                row.fingerprint = fingerprint
+                owners[fingerprint] = row
+            else:
+                owner.failures += row.failures
+                db.delete(row)
+                merged += 1
+        return merged
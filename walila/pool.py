@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import random
+import logging
+import threading
+
+import gevent.queue
+from sqlalchemy import exc, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import queue as sqla_queue
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_CHECKIN_AT = 'walila_checkin_at'
+_RECYCLE_AT = 'walila_recycle_at'
+
+
+class _GreenQueue(object):
+    """`sqlalchemy.util.queue.Queue` interface on a gevent queue, so waiting
+    for a connection yields to other greenlets, waiters are served FIFO."""
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._queue = gevent.queue.Queue(maxsize or None)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def full(self):
+        return self._queue.full()
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            self._queue.put(item, block, timeout)
+        except gevent.queue.Full:
+            raise sqla_queue.Full
+
+    def get(self, block=True, timeout=None):
+        try:
+            return self._queue.get(block, timeout)
+        except gevent.queue.Empty:
+            raise sqla_queue.Empty
+
+
+class GreenQueuePool(QueuePool):
+    """`QueuePool` tuned for gevent.
+
+    * checkouts wait on a gevent queue, fairly, for at most `timeout`
+    * connections idle for more than `pre_ping_interval` seconds are pinged
+      on checkout and reconnected if dead, instead of pinging every checkout
+    * checkout wait time, checked out connections, overflows and timeouts
+      are recorded to :data:`walila.metrics.metrics` as
+      ``<metric_prefix>.wait|checkedout|overflow|timeout``
+
+    Use it by `DB_POOL_CLASS` ``green`` or ``pool_class`` of `DB_SETTINGS`.
+    """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30,
+                 pre_ping_interval=None, metric_prefix='db.pool', **kw):
+        QueuePool.__init__(self, creator, pool_size=pool_size,
+                           max_overflow=max_overflow, timeout=timeout, **kw)
+        self._pool = _GreenQueue(pool_size)
+        self._pre_ping_interval = pre_ping_interval
+        self.metric_prefix = metric_prefix
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            rec = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            metrics.incr(self.metric_prefix + '.timeout')
+            raise
+        metrics.timing(self.metric_prefix + '.wait', time.time() - start)
+        metrics.gauge(self.metric_prefix + '.checkedout', self.checkedout())
+        self._maybe_ping(rec)
+        return rec
+
+    def _do_return_conn(self, conn):
+        conn.info[_CHECKIN_AT] = time.time()
+        QueuePool._do_return_conn(self, conn)
+
+    def _inc_overflow(self):
+        created = QueuePool._inc_overflow(self)
+        if created and self._overflow > 0:
+            metrics.incr(self.metric_prefix + '.overflow')
+        return created
+
+    def _maybe_ping(self, rec):
+        checkin_at = rec.info.get(_CHECKIN_AT)
+        if not self._pre_ping_interval or rec.connection is None or \
+                checkin_at is None or \
+                time.time() - checkin_at < self._pre_ping_interval:
+            return
+        try:
+            cursor = rec.connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except Exception as e:
+            logger.warning("Connection idle for %ds is dead, reconnect: %r",
+                           time.time() - checkin_at, e)
+            metrics.incr(self.metric_prefix + '.dead')
+            # reconnected by `_ConnectionRecord.get_connection`
+            rec.invalidate(e)
+
+    def recreate(self):
+        self.logger.info("Pool recreating")
+        return self.__class__(self._creator, pool_size=self._pool.maxsize,
+                              max_overflow=self._max_overflow,
+                              timeout=self._timeout,
+                              pre_ping_interval=self._pre_ping_interval,
+                              metric_prefix=self.metric_prefix,
+                              recycle=self._recycle, echo=self.echo,
+                              logging_name=self._orig_logging_name,
+                              use_threadlocal=self._use_threadlocal,
+                              reset_on_return=self._reset_on_return,
+                              _dispatch=self.dispatch,
+                              _dialect=self._dialect)
+
+
+class PoolReaper(object):
+    """Maintain idle connections of the `QueuePool` of an engine in a
+    background thread (greenlet if patched), so checkouts don't wait for
+    connects:
+
+    * idle connections are reconnected between 0.7 and 0.9 of the pool's
+      recycle seconds after they are opened, instead of on checkout after
+      the recycle seconds
+    * connections are opened until `min_idle` are idle, within pool size
+
+    The thread is started again by checkouts in processes forked, e.g.
+    prefork pool processes of celery.
+
+    Recycled and opened connections are recorded to
+    :data:`walila.metrics.metrics` as ``<metric_prefix>.recycled|opened``.
+
+    :param interval: seconds between two reaps
+    """
+
+    def __init__(self, engine, interval, min_idle=0, metric_prefix='db.pool'):
+        self.engine = engine
+        self.interval = interval
+        self.min_idle = min_idle
+        self.metric_prefix = metric_prefix
+        self._running = False
+        self._listening = False
+        self._stopped = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._running = True
+        if not self._listening:
+            event.listen(self.engine, 'checkout', self._on_checkout)
+            self._listening = True
+        self._ensure_worker()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._stopped is not None:
+            self._stopped.set()
+        self._pid = None
+
+    def _on_checkout(self, dbapi_conn, rec, proxy):
+        if self._running:
+            self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._stopped is not None:
+                # of the parent process, or stopped already
+                self._stopped.set()
+            self._stopped = threading.Event()
+            worker = threading.Thread(target=self._reap_forever,
+                                      args=(self._stopped,),
+                                      name='walila-pool-reaper')
+            worker.daemon = True
+            worker.start()
+            self._pid = os.getpid()
+
+    def _reap_forever(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Error reaping pool of %r", self.engine.url)
+
+    def reap(self):
+        """:return: numbers of connections recycled and opened"""
+        # pools are replaced on `engine.dispose`
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return 0, 0
+        return self._recycle(pool), self._fill(pool)
+
+    def _recycle(self, pool):
+        if pool._recycle < 0:
+            return 0
+        recycled = 0
+        # each idle connection is taken out once, put back at the end
+        for _ in range(pool.checkedin()):
+            try:
+                rec = pool._pool.get(False)
+            except sqla_queue.Empty:
+                break
+            if rec.connection is not None and \
+                    time.time() >= self._recycle_at(pool, rec):
+                if not self._reconnect(pool, rec):
+                    continue
+                recycled += 1
+            self._put_back(pool, rec)
+        if recycled:
+            metrics.incr(self.metric_prefix + '.recycled', recycled)
+        return recycled
+
+    def _put_back(self, pool, rec):
+        # not by `_do_return_conn`, which stamps the check-in of
+        # `GreenQueuePool` and so defers pre-pings of idle connections
+        try:
+            pool._pool.put(rec, False)
+        except sqla_queue.Full:
+            # filled by connections returned meanwhile
+            rec.close()
+            pool._dec_overflow()
+
+    def _recycle_at(self, pool, rec):
+        # jittered so connections opened together are not recycled together,
+        # cleared with `info` on reconnect
+        recycle_at = rec.info.get(_RECYCLE_AT)
+        if recycle_at is None:
+            recycle_at = rec.info[_RECYCLE_AT] = rec.starttime + max(
+                pool._recycle * random.uniform(0.7, 0.9) - self.interval, 0)
+        return recycle_at
+
+    def _reconnect(self, pool, rec):
+        try:
+            # reconnected by `_ConnectionRecord.get_connection`
+            rec.invalidate(soft=True)
+            rec.get_connection()
+        except Exception:
+            logger.exception("Error recycling connection of %r",
+                             self.engine.url)
+            rec.close()
+            pool._dec_overflow()
+            return False
+        return True
+
+    def _fill(self, pool):
+        opened = 0
+        # connections beyond pool size would be closed when returned
+        while pool.checkedin() < self.min_idle and pool.overflow() < 0:
+            if not pool._inc_overflow():
+                break
+            try:
+                rec = pool._create_connection()
+            except Exception:
+                pool._dec_overflow()
+                logger.exception("Error opening connection of %r",
+                                 self.engine.url)
+                break
+            pool._do_return_conn(rec)
+            opened += 1
+        if opened:
+            metrics.incr(self.metric_prefix + '.opened', opened)
+        return opened
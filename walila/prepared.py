@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""Server-side prepared statements of selects, for engines of
+``mysql+mysqlconnector`` urls, which speak the binary protocol.
+
+Enabled by ``prepared_statements`` of `DB_SETTINGS` (or
+`DB_PREPARED_STATEMENTS`), the number of statements kept prepared on each
+connection. Compiled selects are prepared once per connection, and executed
+by their statement ids afterwards, so the server doesn't parse them again.
+The least recently used are closed when there are more. Connections are
+opened with ``use_pure``, prepared cursors are of the pure python driver.
+
+Pair it with `DB_BAKED_QUERIES`, so hot primary key gets are compiled once
+on the client side too.
+"""
+
+import collections
+import logging
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_STATEMENTS = 'walila_prepared_statements'
+
+
+class StatementCache(object):
+    """LRU of statements prepared on a DBAPI connection of mysql-connector,
+    ``{sql: statement}``, statements evicted are closed on the server.
+
+    Kept in `info` of the connection record, which is cleared when the
+    connection is invalidated or reconnected, so are the statements.
+    """
+
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.size = size
+        self._statements = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def get(self, operation):
+        """Statement of `operation`, prepared if not yet"""
+        statement = self._statements.pop(operation, None)
+        if statement is None:
+            statement = self._prepare(operation)
+            while len(self._statements) >= self.size:
+                _, evicted = self._statements.popitem(last=False)
+                self._close(evicted)
+        self._statements[operation] = statement
+        return statement
+
+    def _prepare(self, operation):
+        from mysql.connector.cursor import RE_SQL_FIND_PARAM
+        if isinstance(operation, unicode):
+            operation = operation.encode(self.connection.python_charset)
+        # `format` placeholders of sqlalchemy to the ones of the server
+        return self.connection.cmd_stmt_prepare(
+            RE_SQL_FIND_PARAM.sub('?', operation))
+
+    def _close(self, statement):
+        try:
+            self.connection.cmd_stmt_close(statement['statement_id'])
+        except Exception:
+            logger.warning("Error closing prepared statement", exc_info=True)
+
+
+_cursor_class = None
+
+
+def _get_cursor_class():
+    global _cursor_class
+    if _cursor_class is not None:
+        return _cursor_class
+    from mysql.connector import errors
+    from mysql.connector.cursor import MySQLCursorPrepared
+
+    class PreparedCursor(MySQLCursorPrepared):
+        """Execute statements of :class:`StatementCache` `statements`,
+        instead of preparing them by every cursor"""
+
+        statements = None
+
+        def execute(self, operation, params=(), multi=False):
+            if not operation:
+                return None
+            self._connection.handle_unread_result()
+            statement = self.statements.get(operation)
+            params = params or ()
+            if len(statement['parameters']) != len(params):
+                raise errors.ProgrammingError(
+                    "Incorrect number of arguments executing prepared "
+                    "statement")
+            self._prepared, self._executed = statement, operation
+            self._handle_result(self._connection.cmd_stmt_execute(
+                statement['statement_id'], data=params,
+                parameters=statement['parameters']))
+
+        def close(self):
+            # closed by the cache when evicted, not by the cursor
+            self._prepared = None
+            super(PreparedCursor, self).close()
+
+    _cursor_class = PreparedCursor
+    return _cursor_class
+
+
+def prepared_cursor(connection, size):
+    """Cursor of the pooled `connection` executing prepared statements, at
+    most `size` of them are kept prepared"""
+    statements = connection.info.get(_STATEMENTS)
+    if statements is None or statements.connection is not \
+            connection.connection:
+        statements = connection.info[_STATEMENTS] = StatementCache(
+            connection.connection, size)
+    cursor = connection.cursor(cursor_class=_get_cursor_class())
+    cursor.statements = statements
+    return cursor
+
+
+def install(engine, size):
+    """Execute selects of `engine` by prepared statements, `size` of them
+    kept on each connection"""
+    if engine.dialect.driver != 'mysqlconnector':
+        raise ValueError("Prepared statements need a mysql+mysqlconnector "
+                         "url, got %r" % engine.url)
+    engine.update_execution_options(prepared_statements=size)
+
+    @event.listens_for(engine, 'invalidate')
+    def forget_statements(dbapi_conn, rec, exception):
+        rec.info.pop(_STATEMENTS, None)
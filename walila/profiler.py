@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Profile statements executed by engines of :data:`walila.db.db_manager`.
+
+Enabled by `DB_PROFILE`:
+
+    * statements are timed to :data:`walila.metrics.metrics` as
+      ``db.<db>.<role>.query``
+    * statements slower than `DB_SLOW_QUERY_THRESHOLD` seconds are logged and
+      aggregated by fingerprint, the slowest `DB_SLOW_QUERY_TOP_N` kept
+    * plans of selects slower than `DB_EXPLAIN_THRESHOLD` are captured once
+      per fingerprint by :class:`walila.db.Explain`
+    * a fingerprint executed `DB_N_PLUS_ONE_THRESHOLD` times in a request or
+      task is reported as a N+1 pattern
+
+e.g.
+
+    from walila.profiler import query_profiler
+
+    query_profiler.report()
+
+"""
+
+import re
+import time
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.sql.expression import Select
+
+from .settings import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_START_AT = 'walila_profile_start_at'
+_EXPLAINING = 'walila_profile_explaining'
+
+_FINGERPRINT_SUBS = (
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def fingerprint(statement):
+    """Normalize `statement` by replacing literals and placeholders, so
+    statements of the same shape have the same fingerprint"""
+    for pattern, repl in _FINGERPRINT_SUBS:
+        statement = pattern.sub(repl, statement)
+    return statement.strip()
+
+
+class SlowQuery(object):
+
+    def __init__(self, fingerprint, statement):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.plan = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'statement': self.statement,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'plan': self.plan,
+        }
+
+
+class QueryProfiler(object):
+    """Listen to cursor executions of engines, installed by
+    :class:`walila.db.DBManager` if `DB_PROFILE`."""
+
+    def __init__(self):
+        self.slow_queries = {}
+        self.n_plus_one = {}
+        self._lock = threading.Lock()
+        # greenlet local if threads are patched
+        self._request = threading.local()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault(_START_AT, []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        starts = conn.info.get(_START_AT)
+        if not starts:
+            return
+        elapsed = time.time() - starts.pop()
+        if conn.info.get(_EXPLAINING):
+            return
+        options = conn._execution_options
+        metrics.timing('db.%s.%s.query' % (options.get('db', 'default'),
+                                           options.get('role', 'default')),
+                       elapsed)
+
+        key = None
+        if elapsed >= settings.DB_SLOW_QUERY_THRESHOLD:
+            key = fingerprint(statement)
+            self._record_slow(conn, context, key, statement, elapsed)
+        if settings.DB_N_PLUS_ONE_THRESHOLD:
+            self._count(key or fingerprint(statement))
+
+    def _handle_error(self, context):
+        conn = context.connection
+        if conn is not None and conn.info.get(_START_AT):
+            conn.info[_START_AT].pop()
+
+    def _record_slow(self, conn, context, key, statement, elapsed):
+        logger.warning("Slow query %.3fs on %s: %s", elapsed,
+                       conn._execution_options.get('role'), statement)
+        metrics.incr('db.slow_query')
+        with self._lock:
+            query = self.slow_queries.get(key)
+            if query is None:
+                query = self.slow_queries[key] = SlowQuery(key, statement)
+            # counted first, or the new one is always the fastest
+            query.add(elapsed)
+            if len(self.slow_queries) > settings.DB_SLOW_QUERY_TOP_N:
+                fastest = min(self.slow_queries.itervalues(),
+                              key=lambda q: q.total)
+                del self.slow_queries[fastest.fingerprint]
+                if fastest is query:
+                    return
+        threshold = settings.DB_EXPLAIN_THRESHOLD
+        if threshold and elapsed >= threshold and query.plan is None:
+            query.plan = self._explain(conn, context)
+
+    def _explain(self, conn, context):
+        from .db import Explain
+        compiled = getattr(context, 'compiled', None)
+        if compiled is None or not isinstance(compiled.statement, Select) or \
+                context.execution_options.get('stream_results'):
+            return None
+        conn.info[_EXPLAINING] = True
+        try:
+            rows = conn.execute(Explain(compiled.statement),
+                                context.compiled_parameters[0]).fetchall()
+            return [dict(row) for row in rows]
+        except Exception:
+            logger.warning("Error explaining %s", compiled.statement,
+                           exc_info=True)
+            return None
+        finally:
+            conn.info[_EXPLAINING] = False
+
+    def _count(self, key):
+        counts = getattr(self._request, 'counts', None)
+        if counts is None:
+            counts = self._request.counts = {}
+        counts[key] = count = counts.get(key, 0) + 1
+        if count != settings.DB_N_PLUS_ONE_THRESHOLD:
+            return
+        logger.warning("N+1 queries, executed %d times in a request: %s",
+                       count, key)
+        metrics.incr('db.n_plus_one')
+        with self._lock:
+            self.n_plus_one[key] = self.n_plus_one.get(key, 0) + 1
+
+    def end_request(self):
+        """Reset N+1 counting, at the end of requests and tasks"""
+        self._request.counts = None
+
+    def report(self):
+        """Return slow queries, slowest first, and N+1 fingerprints with the
+        number of requests they were found in"""
+        with self._lock:
+            slow = sorted(self.slow_queries.itervalues(),
+                          key=lambda q: q.total, reverse=True)
+            return {
+                'slow_queries': [query.to_dict() for query in slow],
+                'n_plus_one': dict(self.n_plus_one),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.slow_queries.clear()
+            self.n_plus_one.clear()
+
+
+query_profiler = QueryProfiler()
@@ -7,11 +7,19 @@ import inspect
 import celery
 
 from celery import Task
+from celery.signals import (
+    task_postrun,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 from celery.utils.log import get_task_logger
 
 from ..settings import settings
 from ..config import load_app_config
-from ..model import FailedTask
+from ..db import db_manager, counter_buffer
+from ..profiler import query_profiler
+from .recorder import failed_task_recorder
 
 
 logger = get_task_logger(__name__)
@@ -56,40 +64,49 @@ class RecordErrorsTask(WalilaTask):
         self.save_failed_task(exc, task_id, args, kwargs, einfo)
 
     def save_failed_task(self, exc, task_id, args, kwargs, traceback):
-        """Record failed task to db
+        """Record failed task to db, buffered by `failed_task_recorder`
         :type exc: Exception
         """
-        name = self.name.split('.')[-1]
-        full_name = self.name
-        exception_class = exc.__class__.__name__
-        exception_msg = str(exc).strip()
-        traceback = str(traceback).strip()
-        args = json.dumps(list(args))
-        kwargs = json.dumps(kwargs)
-        need_retry = getattr(self, 'retry_if_fail', True)
-
-        # Find if task with same args, name and exception already exists,
-        # If do, update failures count
-        existing_task = FailedTask.get_task(
-            full_name, args, kwargs, exception_class, exception_msg)
-
-        if existing_task:
-            failures = existing_task.failures + 1
-            existing_task.update(failures=failures)
-            logger.info(
-                "Update failed task %r failures to %d ", full_name, failures)
-        else:
-            FailedTask.add(
-                name=name,
-                full_name=full_name,
-                args=args,
-                kwargs=kwargs,
-                exception_class=exception_class,
-                exception_msg=exception_msg,
-                traceback=traceback,
-                task_id=task_id,
-                need_retry=need_retry)
-            logger.info("Add failed task %r", full_name)
+        failed_task_recorder.record(
+            name=self.name.split('.')[-1],
+            full_name=self.name,
+            args=json.dumps(list(args)),
+            kwargs=json.dumps(kwargs),
+            exception_class=exc.__class__.__name__,
+            exception_msg=str(exc).strip(),
+            traceback=str(traceback).strip(),
+            task_id=task_id,
+            need_retry=getattr(self, 'retry_if_fail', True))
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_failed_tasks(**kwargs):
+    """Do not lose buffered failed tasks when worker exits"""
+    failed_task_recorder.flush()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_counters(**kwargs):
+    """Do not lose buffered counters when worker exits"""
+    counter_buffer.flush()
+
+
+@worker_process_init.connect
+def warm_up_pool_process(**kwargs):
+    """Open own db connections in each prefork pool process, instead of
+    sharing the sockets of the main process, which doesn't warm up"""
+    from ..env import warm_up_db
+    db_manager.reset_pools()
+    warm_up_db()
+
+
+@task_postrun.connect
+def remove_db_sessions(**kwargs):
+    """Remove sessions of the task, in the greenlet/thread executed it"""
+    db_manager.close_sessions()
+    query_profiler.end_request()
 
 
 def _bind_own_base_task(func):
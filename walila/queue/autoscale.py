@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""Scale celery worker pool by the depth of the queues consumed.
+
+Enabled by ``walila consume --autoscale MAX,MIN``, the policy and its options
+are taken from settings:
+
+    * ``AUTOSCALE_POLICY``: dotted path of an :class:`AutoscalePolicy`
+    * ``AUTOSCALE_INTERVAL``: seconds between two queue depth polls
+    * ``AUTOSCALE_COOLDOWN``: min seconds between two pool size changes
+    * ``AUTOSCALE_MAX_STEP``: max processes grown or shrunk at a time
+    * ``AUTOSCALE_BACKLOG_PER_WORKER``: backlog a worker is expected to
+      consume, used by :class:`QueueDepthPolicy`
+"""
+
+import math
+import logging
+
+from celery.five import monotonic
+from celery.signals import celeryd_init
+from celery.utils.imports import symbol_by_name
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+
+from ..settings import settings
+from ..config import load_app_config
+
+logger = logging.getLogger(__name__)
+
+
+class AutoscalePolicy(object):
+    """Decide how many workers the pool should have"""
+
+    def desired(self, processes, reserved, messages, consumers):
+        """
+        :param processes: current pool size
+        :param reserved: tasks reserved by this worker
+        :param messages: messages ready in the consumed queues
+        :param consumers: consumers of the consumed queues
+        :return: desired pool size, bounded by the autoscaler later
+        """
+        raise NotImplementedError
+
+
+class QueueDepthPolicy(AutoscalePolicy):
+    """Keep a worker for every reserved task, plus enough workers for this
+    consumer's share of the backlog."""
+
+    def __init__(self, backlog_per_worker=None):
+        self.backlog_per_worker = backlog_per_worker or \
+            settings.AUTOSCALE_BACKLOG_PER_WORKER
+
+    def desired(self, processes, reserved, messages, consumers):
+        share = float(messages) / max(consumers, 1)
+        return reserved + int(math.ceil(share / self.backlog_per_worker))
+
+
+class QueueDepthAutoscaler(Autoscaler):
+    """Celery autoscaler driven by :class:`AutoscalePolicy`.
+
+    Queue depth is polled by passive declares at most every
+    `AUTOSCALE_INTERVAL` seconds, and the pool size is changed at most every
+    `AUTOSCALE_COOLDOWN` seconds by `AUTOSCALE_MAX_STEP` processes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(QueueDepthAutoscaler, self).__init__(*args, **kwargs)
+        self.policy = symbol_by_name(settings.AUTOSCALE_POLICY)()
+        self.interval = settings.AUTOSCALE_INTERVAL
+        self.cooldown = settings.AUTOSCALE_COOLDOWN
+        self.max_step = settings.AUTOSCALE_MAX_STEP
+        self.queues = load_app_config().async_queues.split(',')
+        self._depth = (0, 0)
+        self._last_poll = None
+        self._last_change = None
+
+    def poll_depth(self):
+        """Return ``(messages, consumers)`` of the consumed queues"""
+        now = monotonic()
+        if self._last_poll is not None and \
+                now - self._last_poll < self.interval:
+            return self._depth
+        self._last_poll = now
+        messages = consumers = 0
+        try:
+            with self.worker.app.connection_for_read() as conn:
+                channel = conn.default_channel
+                for queue in self.queues:
+                    _, n_messages, n_consumers = channel.queue_declare(
+                        queue=queue, passive=True)
+                    messages += n_messages
+                    consumers += n_consumers
+        except Exception:
+            logger.exception("Error polling depth of queues %r", self.queues)
+        else:
+            self._depth = (messages, consumers)
+        return self._depth
+
+    def _maybe_scale(self, req=None):
+        now = monotonic()
+        if self._last_change is not None and \
+                now - self._last_change < self.cooldown:
+            return False
+        procs = self.processes
+        messages, consumers = self.poll_depth()
+        desired = self.policy.desired(
+            procs, len(state.reserved_requests), messages, consumers)
+        desired = max(self.min_concurrency,
+                      min(desired, self.max_concurrency))
+        if desired > procs:
+            self.scale_up(min(desired - procs, self.max_step))
+        elif desired < procs:
+            self._shrink(min(procs - desired, self.max_step))
+        else:
+            return False
+        self._last_change = now
+        return True
+
+    def info(self):
+        info = super(QueueDepthAutoscaler, self).info()
+        info.update(messages=self._depth[0], consumers=self._depth[1])
+        return info
+
+
+@celeryd_init.connect
+def install_autoscaler(conf=None, **kwargs):
+    """Use :class:`QueueDepthAutoscaler` for worker started in this process"""
+    conf['worker_autoscaler'] = \
+        'walila.queue.autoscale:QueueDepthAutoscaler'
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from ..settings import settings
+from ..model import FailedTask, failed_task_db
+from ..writebehind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+
+def truncate_traceback(traceback, limit=None):
+    """Keep the last `limit` (default `FAILED_TASK_TRACEBACK_LIMIT`)
+    characters of `traceback`, where the exception is"""
+    limit = limit or settings.FAILED_TASK_TRACEBACK_LIMIT
+    if traceback is None or len(traceback) <= limit:
+        return traceback
+    return '...\n' + traceback[-limit:]
+
+
+class FailedTaskRecorder(WriteBehindBuffer):
+    """Buffer failed tasks in memory and save them to db in batches.
+
+    Failures are aggregated by :meth:`FailedTask.make_fingerprint`, then
+    flushed with one upsert every `flush_interval` seconds or when the buffer
+    reaches `buffer_size`, so a failure storm wouldn't become a db storm.
+
+    :param flush_interval: seconds between two flushes, default
+     `FAILED_TASK_FLUSH_INTERVAL`
+    :param buffer_size: max distinct failures buffered before flushing,
+     default `FAILED_TASK_BUFFER_SIZE`
+    """
+
+    name = 'failed-task'
+    FLUSH_INTERVAL_SETTING = 'FAILED_TASK_FLUSH_INTERVAL'
+    BUFFER_SIZE_SETTING = 'FAILED_TASK_BUFFER_SIZE'
+
+    def __init__(self, flush_interval=None, buffer_size=None):
+        super(FailedTaskRecorder, self).__init__(flush_interval, buffer_size)
+        self._db_checked = False
+
+    def record(self, name, full_name, args, kwargs, exception_class,
+               exception_msg, traceback, task_id, need_retry):
+        if not self._db_checked:
+            # fail fast, instead of dropping every batch flushed
+            failed_task_db()
+            self._db_checked = True
+        fingerprint = FailedTask.make_fingerprint(
+            full_name, args, kwargs, exception_class, exception_msg)
+        self._put(fingerprint, {
+            'fingerprint': fingerprint,
+            'name': name,
+            'full_name': full_name,
+            'args': args,
+            'kwargs': kwargs,
+            'exception_class': exception_class,
+            'exception_msg': exception_msg,
+            'traceback': truncate_traceback(traceback),
+            'task_id': task_id,
+            'need_retry': need_retry,
+            'failures': 1,
+        })
+
+    def _merge(self, old, new):
+        # keep the latest failure's context
+        return dict(new, failures=old['failures'] + new['failures'])
+
+    def _save(self, items):
+        rows = items.values()
+        FailedTask.save_failures(rows)
+        logger.info("Saved %d failed tasks", len(rows))
+        return sum(row['failures'] for row in rows)
+
+
+failed_task_recorder = FailedTaskRecorder()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+from gevent.pool import Pool
+
+from ..model import FailedTask
+
+logger = logging.getLogger(__name__)
+
+
+class FailedTaskRetrier(object):
+    """Replay failed tasks through the task manager, batch by batch.
+
+    Need retry tasks are paged by `id` so that only one batch is in memory,
+    each batch is dispatched by a greenlet pool of `concurrency`, then the
+    dispatched ones are deleted (or marked as no need to retry) in bulk.
+    Tasks not registered in the task manager are left untouched.
+
+    :param batch_size: tasks loaded and finished per batch
+    :param concurrency: max tasks being dispatched at the same time
+    :param delete: delete dispatched tasks if `True`, else set their
+     `need_retry` to `False`
+    :param names: only retry tasks of these names if given
+    :param task_manager: default `walila.queue.async.task_manager`
+    """
+
+    def __init__(self, batch_size=500, concurrency=20, delete=True,
+                 names=None, task_manager=None):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.delete = delete
+        self.names = names
+        if task_manager is None:
+            from .async import task_manager
+        self.task_manager = task_manager
+
+    def run(self):
+        """Retry all need retry tasks.
+
+        :return: ``(dispatched, skipped)`` counts
+        """
+        dispatched = skipped = 0
+        for rows in FailedTask.iter_need_retry(self.batch_size, self.names):
+            ids = self.dispatch(rows)
+            FailedTask.finish_retry(ids, delete=self.delete)
+            dispatched += len(ids)
+            skipped += len(rows) - len(ids)
+            logger.info("Retried %d failed tasks, %d skipped so far",
+                        dispatched, skipped)
+        return dispatched, skipped
+
+    def dispatch(self, rows):
+        """Dispatch a batch of tasks, return ids of the dispatched ones"""
+        pool = Pool(self.concurrency)
+        results = pool.map(self._dispatch_one, rows)
+        return [row.id for row, ok in zip(rows, results) if ok]
+
+    def _dispatch_one(self, row):
+        if row.name not in self.task_manager:
+            logger.warning("Task %r is not registered, skip %d",
+                           row.name, row.id)
+            return False
+        try:
+            args = json.loads(row.args) if row.args else ()
+            kwargs = json.loads(row.kwargs) if row.kwargs else {}
+            self.task_manager.apply_async(row.name, *args, **kwargs)
+        except Exception:
+            logger.exception("Error retrying failed task %d", row.id)
+            return False
+        return True
@@ -47,6 +47,9 @@ class WalilaWsgiApp(SetAppMixin, WSGIApplication):
 
     def install_hooks(self):
         self.cfg.set('post_fork', hooks.post_fork)
+        self.cfg.set('post_worker_init', hooks.post_worker_init)
+        self.cfg.set('post_request', hooks.post_request)
+        self.cfg.set('worker_exit', hooks.worker_exit)
 
 
 def serve():
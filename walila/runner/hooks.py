@@ -5,4 +5,24 @@ def post_fork(server, worker):
     worker.app.chdir()
     from ..env import initialize
     # initialize worker process envrionment post fork before init_process
-    initialize()
+    initialize(warm_up=False)
+
+
+def post_worker_init(worker):
+    from ..env import warm_up_db
+    # after gevent patched by gevent workers, before accepting traffic
+    warm_up_db()
+
+
+def post_request(worker, req, environ, resp):
+    from ..db import db_manager
+    from ..profiler import query_profiler
+    # remove sessions of the request, in the greenlet handled it
+    db_manager.close_sessions()
+    query_profiler.end_request()
+
+
+def worker_exit(server, worker):
+    from ..db import counter_buffer
+    # do not lose buffered counters when worker exits
+    counter_buffer.flush()
@@ -68,6 +68,9 @@ class BaseConfig(object):
             return False
         if type is not None and issubclass(type, basestring):
             type = basestring
+        # e.g. `0` for thresholds in seconds
+        if type is float:
+            type = (int, long, float)
         if type is not None and not isinstance(value, type):
             return False
         return True
@@ -183,7 +186,86 @@ class Config(DefaultConfig):
         "DB_POOL_SIZE": 10,
         "DB_MAX_OVERFLOW": 1,
         "DB_POOL_RECYCLE": 300,
+        "DB_POOL_TIMEOUT": 30,
+        # `queue` for sqlalchemy `QueuePool`, `green` for
+        # `walila.pool.GreenQueuePool`
+        "DB_POOL_CLASS": "queue",
+        # ping connections idle for more seconds on checkout, green pool only
+        "DB_POOL_PRE_PING_INTERVAL": 30.0,
+        # seconds between reaps of idle connections in background, which
+        # recycles them before `DB_POOL_RECYCLE` and keeps `DB_POOL_MIN_IDLE`
+        # idle, `0` to disable, see `walila.pool.PoolReaper`. `pool_min_idle`
+        # of `DB_SETTINGS` may be a dict of `{role: n}`
+        "DB_POOL_REAP_INTERVAL": 10.0,
+        "DB_POOL_MIN_IDLE": 0,
+        # connections opened per engine before a worker serves, `0` to
+        # disable, and queries run on them, see `walila.db.DBManager.warm_up`
+        "DB_WARM_UP_CONNECTIONS": 0,
+        "DB_WARM_UP_QUERIES": default_empty([]),
+        "DB_WARM_UP_TIMEOUT": 10.0,
         "DB_SETTINGS": default_empty({}),
+        # `{name: {'shards': [db, ...], 'shard_key': 'hash'}}`, shards are
+        # names of `DB_SETTINGS`, see `walila.db.ShardedRoutingSession`
+        "DB_SHARDS": default_empty({}),
+        # seconds of queries run by `walila.db.DBManager.gather`, `0` for no
+        # timeout
+        "DB_GATHER_TIMEOUT": 10.0,
+        # `off`, `sample` or `strict`, by env if empty, see `walila.typecheck`
+        "DB_TYPE_CHECK": default_empty(""),
+        "DB_TYPE_CHECK_SAMPLE_RATE": 0.01,
+        # rows an `UpsertMixin.bulk_upsert` statement carries at most, and
+        # `max_allowed_packet` of mysql servers
+        "DB_BULK_UPSERT_CHUNK_SIZE": 1000,
+        "DB_MAX_ALLOWED_PACKET": 4 * 1024 * 1024,
+        # rows a chunk of `RoutingSession.stream` and `.iter_keyset` has
+        "DB_STREAM_CHUNK_SIZE": 1000,
+        # bake primary key gets of `RoutingQuery`, built and compiled once
+        "DB_BAKED_QUERIES": False,
+        # selects prepared on the server kept per connection, `0` to disable,
+        # `mysql+mysqlconnector` urls only, see `walila.prepared`
+        "DB_PREPARED_STATEMENTS": 0,
+        # write-behind counters, see `walila.db.CounterBuffer`
+        "DB_COUNTER_FLUSH_INTERVAL": 5.0,
+        "DB_COUNTER_BUFFER_SIZE": 10000,
+        # seconds sessions wait for rollback/close, connections timed out
+        # are cleaned up in background within `DB_QUARANTINE_TIMEOUT`, by
+        # `DB_QUARANTINE_CONCURRENCY` workers
+        "DB_CLOSE_TIMEOUT": 5.0,
+        "DB_QUARANTINE_TIMEOUT": 30.0,
+        "DB_QUARANTINE_CONCURRENCY": 10,
+        # profile statements, see `walila.profiler`, thresholds in seconds,
+        # `DB_EXPLAIN_THRESHOLD` and `DB_N_PLUS_ONE_THRESHOLD` `0` to disable
+        "DB_PROFILE": False,
+        "DB_SLOW_QUERY_THRESHOLD": 0.5,
+        "DB_SLOW_QUERY_TOP_N": 50,
+        "DB_EXPLAIN_THRESHOLD": 1.0,
+        "DB_N_PLUS_ONE_THRESHOLD": 20,
+        # `greenlet` or `thread`, see `walila.db.make_session`
+        "DB_SESSION_SCOPE": "greenlet",
+        # seconds between replica health samples, `0` to disable
+        "DB_REPLICA_CHECK_INTERVAL": 5.0,
+        # replicas lagging more seconds than this are not read from
+        "DB_REPLICA_MAX_LAG": 30.0,
+        # read from master after a session writes, for `_WINDOW` seconds or
+        # until the end of the request/task if `0`, see
+        # `walila.db.ReadYourWrites`
+        "DB_READ_YOUR_WRITES": False,
+        "DB_READ_YOUR_WRITES_WINDOW": 0.0,
+        "DB_READ_YOUR_WRITES_GTID": False,
+
+        # cache, see `walila.cache`
+        "CACHE_REDIS_URL": default_empty(""),
+        "CACHE_KEY_PREFIX": "walila",
+        # defaults of `walila.cache.CacheClient`, local LRU disabled if `0`
+        "CACHE_TTL": 3600,
+        "CACHE_NEGATIVE_TTL": 60,
+        "CACHE_LOCAL_SIZE": 1000,
+        "CACHE_LOCAL_TTL": 5,
+        # broadcast keys deleted to local LRUs of all processes, see
+        # `walila.cache.InvalidationBus`
+        "CACHE_INVALIDATION_BUS": False,
+        "CACHE_INVALIDATION_CHANNEL": "walila:cache:invalidation",
+        "CACHE_INVALIDATION_BATCH_SIZE": 500,
 
         # default logger name
         "LOGGER_NAME": "SouthPay",
@@ -191,6 +273,21 @@ class Config(DefaultConfig):
         # async
         "ASYNC_ENABLED": False,
 
+        # failed task recording, `FAILED_TASK_DB` is the name in `DB_SETTINGS`,
+        # the only one of it if empty, see `walila.model.failed_task_db`
+        "FAILED_TASK_DB": default_empty(""),
+        "FAILED_TASK_FLUSH_INTERVAL": 5.0,
+        "FAILED_TASK_BUFFER_SIZE": 500,
+        # characters of tracebacks kept, the last ones
+        "FAILED_TASK_TRACEBACK_LIMIT": 8192,
+
+        # worker autoscaling, see `walila.queue.autoscale`
+        "AUTOSCALE_POLICY": "walila.queue.autoscale:QueueDepthPolicy",
+        "AUTOSCALE_INTERVAL": 5.0,
+        "AUTOSCALE_COOLDOWN": 10.0,
+        "AUTOSCALE_MAX_STEP": 4,
+        "AUTOSCALE_BACKLOG_PER_WORKER": 10,
+
         # statsd
         "STATSD_SETTINGS": default_empty("")
     }
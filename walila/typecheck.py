@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Check python types of values bound to `Integer` and `String` columns.
+
+The mode is `DB_TYPE_CHECK`, or decided by env if it's empty:
+
+    * ``off`` (prod): bind processors are left untouched, no overhead
+    * ``sample`` (testing): `DB_TYPE_CHECK_SAMPLE_RATE` of values are checked
+    * ``strict`` (dev): every value is checked
+
+Values of wrong types are not rejected, violations are counted per column
+and logged once per column, see :meth:`TypeChecker.report`.
+"""
+
+import random
+import logging
+import functools
+import threading
+import weakref
+
+from sqlalchemy import Column, Table, event
+from sqlalchemy.types import Integer, String
+
+from .settings import settings
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MODE_OFF = 'off'
+MODE_SAMPLE = 'sample'
+MODE_STRICT = 'strict'
+MODES = (MODE_OFF, MODE_SAMPLE, MODE_STRICT)
+
+CHECKED_TYPES = (
+    (Integer, (int, long)),
+    (String, basestring),
+)
+
+# `table.column` of column types, to label violations
+_labels = weakref.WeakKeyDictionary()
+
+
+@event.listens_for(Column, 'after_parent_attach')
+def _label_column_type(column, table):
+    # also fired for proxies of columns in selects, of the same types
+    if not isinstance(table, Table):
+        return
+    try:
+        _labels[column.type] = '%s.%s' % (table.name, column.name)
+    except TypeError:
+        pass
+
+
+def default_mode():
+    from .env import is_in_prod, is_in_testing
+    if is_in_prod():
+        return MODE_OFF
+    if is_in_testing():
+        return MODE_SAMPLE
+    return MODE_STRICT
+
+
+class TypeChecker(object):
+    """Wrap bind processors of :data:`CHECKED_TYPES` to check values bound,
+    installed by :func:`walila.env.create_db_sessions`."""
+
+    _PATCHED = ('bind_processor', '_dialect_info', 'coerce_compared_value')
+
+    def __init__(self):
+        self.mode = MODE_OFF
+        self.sample_rate = 1.0
+        self.violations = {}
+        self._lock = threading.Lock()
+        self._origins = None
+
+    @property
+    def installed(self):
+        return self._origins is not None
+
+    def install(self, mode=None, sample_rate=None):
+        """Install for `mode` (default `DB_TYPE_CHECK`), uninstall if it's
+        ``off``. NOTE: install before engines are created, processors are
+        memoized by dialects."""
+        mode = mode or settings.DB_TYPE_CHECK or default_mode()
+        if mode not in MODES:
+            raise ValueError("Unknown type check mode %r" % mode)
+        self.mode = mode
+        self.sample_rate = settings.DB_TYPE_CHECK_SAMPLE_RATE \
+            if sample_rate is None else sample_rate
+        if mode == MODE_OFF:
+            return self.uninstall()
+        if self.installed:
+            return
+        self._origins = {}
+        for type_, pytypes in CHECKED_TYPES:
+            self._origins[type_] = {name: type_.__dict__.get(name)
+                                    for name in self._PATCHED}
+            type_.bind_processor = self._wrap(type_.bind_processor, pytypes)
+            type_._dialect_info = _label_dialect_impl(type_._dialect_info)
+            # check values compared with columns by the types of columns
+            type_.coerce_compared_value = _coerce_compared_value
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        for type_, origins in self._origins.iteritems():
+            for name, origin in origins.iteritems():
+                if origin is None:
+                    delattr(type_, name)
+                else:
+                    setattr(type_, name, origin)
+        self._origins = None
+
+    def _wrap(self, bind_processor, pytypes):
+        checker = self
+
+        @functools.wraps(bind_processor)
+        def wrapper(type_, dialect):
+            processor = bind_processor(type_, dialect)
+
+            def check(value):
+                if value is not None and not isinstance(value, pytypes) and \
+                        checker._sampled():
+                    checker.record(type_, value)
+                return value if processor is None else processor(value)
+            return check
+        return wrapper
+
+    def _sampled(self):
+        if self.mode == MODE_STRICT:
+            return True
+        return self.mode == MODE_SAMPLE and random.random() < self.sample_rate
+
+    def record(self, type_, value):
+        label = _labels.get(type_) or repr(type_)
+        value_type = type(value).__name__
+        with self._lock:
+            violation = self.violations.get(label)
+            first = violation is None
+            if first:
+                violation = self.violations[label] = {
+                    'type': repr(type_), 'count': 0, 'value_types': set()}
+            violation['count'] += 1
+            violation['value_types'].add(value_type)
+        metrics.incr('db.type_check.violation')
+        if first:
+            logger.warning("Column %s of %r is bound a %s value %r, "
+                           "reported once", label, type_, value_type, value)
+
+    def report(self):
+        """Return ``{column: {'type', 'count', 'value_types'}}`` of
+        violations seen"""
+        with self._lock:
+            return {label: dict(violation,
+                                value_types=sorted(violation['value_types']))
+                    for label, violation in self.violations.iteritems()}
+
+    def reset(self):
+        with self._lock:
+            self.violations.clear()
+
+
+def _coerce_compared_value(self, op, value):
+    return self
+
+
+def _label_dialect_impl(dialect_info):
+    # bind processors are of copies of column types adapted for dialects
+    @functools.wraps(dialect_info)
+    def wrapper(type_, dialect):
+        info = dialect_info(type_, dialect)
+        label = _labels.get(type_)
+        if label is not None:
+            _labels[info['impl']] = label
+        return info
+    return wrapper
+
+
+type_checker = TypeChecker()
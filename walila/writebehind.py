@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    """Buffer items in memory by key and save them in batches by a
+    background flusher, every `flush_interval` seconds or as soon as
+    `buffer_size` keys are buffered. Callers never save, so writes are off
+    their paths and out of their sessions.
+
+    Items of the same key are merged by :meth:`_merge`. Groups of items
+    (:meth:`_groups`) failed to save are requeued, and dropped if the buffer
+    is full.
+
+    Subclasses implement :meth:`_save`, and name settings of the defaults
+    by `FLUSH_INTERVAL_SETTING` and `BUFFER_SIZE_SETTING`.
+
+    :param flush_interval: seconds between two flushes
+    :param buffer_size: max distinct keys buffered before flushing
+    """
+
+    name = 'write-behind'
+    FLUSH_INTERVAL_SETTING = None
+    BUFFER_SIZE_SETTING = None
+
+    def __init__(self, flush_interval=None, buffer_size=None):
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._buffer = {}
+        self._lock = threading.Lock()
+        # held across swapping and saving, so a flush on shutdown waits for
+        # the one of the flusher in progress
+        self._flush_lock = threading.Lock()
+        self._flusher_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    @property
+    def flush_interval(self):
+        return self._flush_interval or \
+            getattr(settings, self.FLUSH_INTERVAL_SETTING)
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size or getattr(settings, self.BUFFER_SIZE_SETTING)
+
+    def _put(self, key, item):
+        with self._lock:
+            existing = self._buffer.get(key)
+            self._buffer[key] = item if existing is None else \
+                self._merge(existing, item)
+            full = len(self._buffer) >= self.buffer_size
+        self._ensure_flusher()
+        if full:
+            self._wakeup.set()
+
+    def _merge(self, old, new):
+        raise NotImplementedError
+
+    def _groups(self, items):
+        """Split `items` of ``{key: item}`` into ones saved together"""
+        return [items]
+
+    def _save(self, items):
+        """Save `items` of ``{key: item}``, return number of them saved"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Save all buffered items, return what :meth:`_save` counts"""
+        with self._flush_lock:
+            with self._lock:
+                items, self._buffer = self._buffer, {}
+            if not items:
+                return 0
+            flushed = 0
+            for group in self._groups(items):
+                try:
+                    flushed += self._save(group)
+                except Exception:
+                    logger.exception("Error saving %d %s, requeue them",
+                                     len(group), self.name)
+                    self._requeue(group)
+            return flushed
+
+    def _requeue(self, items):
+        with self._lock:
+            for key, item in items.iteritems():
+                existing = self._buffer.get(key)
+                if existing is not None:
+                    self._buffer[key] = self._merge(item, existing)
+                elif len(self._buffer) < self.buffer_size:
+                    self._buffer[key] = item
+                else:
+                    logger.error("%s buffer is full, drop %r", self.name, key)
+
+    def _ensure_flusher(self):
+        # started lazily, so that it lives in the (forked) worker process
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._flusher_lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_forever,
+                                             name='%s-flusher' % self.name)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_forever(self):
+        while 1:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing %s", self.name)